@@ -27,6 +27,7 @@ urlpatterns = patterns('',
     url(r'^(?P<uuid>[-\w]+)/update', update, name='update'),
     url(r'^(?P<uuid>[-\w]+)/(?P<current>\d+)/(?P<new>\d+)$', validate, name='validate'),
     url(r'^(?P<uuid>[-\w]+)/(?P<version>\d+)$', vm, name='vm'),
+    url(r'^(?P<uuid>[-\w]+)/(?P<version>\d+)/descriptor$', descriptor, name='descriptor'),
     url(r'^(?P<uuid>[-\w]+)/(?P<version>\d+)/(?P<image>[-\w]+)/size$', size, name='size'),
     url(r'^(?P<uuid>[-\w]+)/(?P<version>\d+)/(?P<image>[-\w]+)/chunk/(?P<num>\d+)/$', chunk, name='chunk'),
     url(r'^version/(?P<uuid>[-\w]+)', version, name='version'),
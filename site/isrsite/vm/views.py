@@ -16,14 +16,17 @@
 #
 
 from collections import OrderedDict
+from hashlib import sha256
 import json
 from urlparse import urljoin
 from django.http import (HttpResponse, HttpResponseForbidden,
-        HttpResponseBadRequest, Http404, HttpResponseNotFound)
+        HttpResponseBadRequest, Http404, HttpResponseNotFound,
+        HttpResponseNotModified)
 from django.conf import settings
 from django.shortcuts import get_object_or_404
 import os
 import shutil
+from django.views.decorators.gzip import gzip_page
 from django.views.decorators.http import require_http_methods
 from .models import *
 
@@ -337,6 +340,44 @@ def vm(request, uuid, version):
     return HttpResponse()
 
 
+''' Returns everything needed to launch a version of a VM in one response:
+    the domain XML, the image sizes, the chunk size and version metadata.
+    The response carries an ETag so clients can revalidate cheaply, and
+    is compressed on the wire if the client accepts it.  Chunk data is
+    sent as is. '''
+@gzip_page
+@require_http_methods(['GET',])
+def descriptor(request, uuid, version):
+    user = _get_user(request)
+    vm = get_object_or_404(VM, uuid=uuid)
+    ver = get_object_or_404(Version, vm=vm, number=int(version))
+    vm_dir = _get_vm_dir(user.name, vm.uuid)
+
+    with open(os.path.join(vm_dir, str(ver.number), 'domain.xml'),
+            'r') as file:
+        domain_xml = file.read()
+    data = json.dumps({
+        'uuid': vm.uuid,
+        'name': vm.name,
+        'version': ver.number,
+        'current_version': vm.current_version,
+        'date_created': ver._datestr(),
+        'chunk_size': settings.CHUNK_SIZE,
+        'disk_size': ver.disk_size,
+        'memory_size': ver.memory_size,
+        'domain_xml': domain_xml,
+    }, sort_keys=True)
+
+    etag = '"%s"' % sha256(data).hexdigest()
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 ''' Change comment of VM which will be committed in the next version '''
 @require_http_methods(['POST'])
 def comment(request, uuid):
@@ -447,39 +488,7 @@ def chunk(request, uuid, version, image, num):
     version = int(version)
 
     if request.method == 'GET':
-        if image not in ('disk', 'memory'):
-            raise Http404
-        dir = _get_chunk_dir(num)
-        vm_dir = _get_vm_dir(vm.user.name, vm.uuid)
-
-        # Make sure version exists
-        ver = get_object_or_404(Version, vm=vm, number=version)
-        if image == 'disk':
-            size = ver.disk_size
-        else:
-            size = ver.memory_size
-
-        # Iterate through versions to find latest version of chunk
-        curr = version
-        while curr > 0:
-            chunk_path = os.path.join(vm_dir,
-                    '%s/%s/%s/%s' % (curr, image, dir, num))
-            if os.path.isfile(chunk_path):
-                break
-            curr -= 1
-        if curr == 0:
-            return HttpResponseNotFound('Chunk not found')
-
-        # Currently returns partial chunks if last chunk is partial. The
-        # alternative is to modify vmnetfs to always request full chunks, but
-        # this change was easier to make (For now)
-        with open(chunk_path, 'r') as file:
-            data = file.read()
-        assert len(data) == settings.CHUNK_SIZE
-        count = size - int(num) * settings.CHUNK_SIZE
-        if count < settings.CHUNK_SIZE:
-            data = data[:count]
-        return HttpResponse(data, content_type='text/plain')
+        return _get_chunk(request, vm, version, image, num)
     elif request.method == 'PUT':
         chunk = request.body
         staging_dir = _get_staging_dir(vm.user.name, vm.uuid, version)
@@ -493,6 +502,45 @@ def chunk(request, uuid, version, image, num):
         return HttpResponse()
 
 
+''' Returns a chunk, compressed on the wire if the client accepts it.
+    Chunks are stored uncompressed, and vmnetfs accepts gzip. '''
+@gzip_page
+def _get_chunk(request, vm, version, image, num):
+    if image not in ('disk', 'memory'):
+        raise Http404
+    dir = _get_chunk_dir(num)
+    vm_dir = _get_vm_dir(vm.user.name, vm.uuid)
+
+    # Make sure version exists
+    ver = get_object_or_404(Version, vm=vm, number=version)
+    if image == 'disk':
+        size = ver.disk_size
+    else:
+        size = ver.memory_size
+
+    # Iterate through versions to find latest version of chunk
+    curr = version
+    while curr > 0:
+        chunk_path = os.path.join(vm_dir,
+                '%s/%s/%s/%s' % (curr, image, dir, num))
+        if os.path.isfile(chunk_path):
+            break
+        curr -= 1
+    if curr == 0:
+        return HttpResponseNotFound('Chunk not found')
+
+    # Currently returns partial chunks if last chunk is partial. The
+    # alternative is to modify vmnetfs to always request full chunks, but
+    # this change was easier to make (For now)
+    with open(chunk_path, 'r') as file:
+        data = file.read()
+    assert len(data) == settings.CHUNK_SIZE
+    count = size - int(num) * settings.CHUNK_SIZE
+    if count < settings.CHUNK_SIZE:
+        data = data[:count]
+    return HttpResponse(data, content_type='text/plain')
+
+
 ''' Claims the lock on a VM. If the request asks for force unlock, just delete
     existing lock and return a new one. Requires a 'machine name' field to set
     as the owner. The client may change this value while a lock is held, and the
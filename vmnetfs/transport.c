@@ -259,6 +259,15 @@ static struct connection *conn_new(struct connection_pool *pool,
                 "Couldn't set fail-on-error flag");
         goto bad;
     }
+    /* Accept any content encoding supported by libcurl, so that chunk
+       fetches can be compressed on the wire.  Data is decoded before
+       write_callback().  Uploads are not affected. */
+    if (curl_easy_setopt(conn->curl, CURLOPT_ENCODING, "")) {
+        g_set_error(err, VMNETFS_TRANSPORT_ERROR,
+                VMNETFS_TRANSPORT_ERROR_FATAL,
+                "Couldn't set accepted encodings");
+        goto bad;
+    }
     return conn;
 
 bad:
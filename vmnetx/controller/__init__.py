@@ -87,7 +87,8 @@ class Controller(gobject.GObject):
         self.password = None
 
     @classmethod
-    def get_for_ref(cls, package_ref, use_spice, throttle_rate='1.0'):
+    def get_for_ref(cls, package_ref, use_spice, throttle_rate='1.0',
+            secret_key=None):
         # Convert package_ref to URL
         url = package_ref
         parsed = urlsplit(url)
@@ -114,7 +115,7 @@ class Controller(gobject.GObject):
                 category = 'Local'
                 from .local import LocalController
                 return LocalController(url=url, use_spice=use_spice,
-                        throttle_rate=throttle_rate)
+                        throttle_rate=throttle_rate, secret_key=secret_key)
         except ImportError:
             raise MachineExecutionError(('%s execution of virtual machines ' +
                     'is not supported on this system') % category)
@@ -16,11 +16,13 @@
 
 import base64
 from calendar import timegm
+from collections import OrderedDict
 import dbus
 from distutils.version import LooseVersion
 import gobject
 import grp
 from hashlib import sha256
+import io
 import json
 import libvirt
 import logging
@@ -31,13 +33,15 @@ import pipes
 import pwd
 import Queue
 import re
+import select
+import shutil
 import signal
 import socket
 import string
 import struct
 import subprocess
 import sys
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 import threading
 import time
 from urlparse import urlsplit, urlunsplit
@@ -45,13 +49,14 @@ import uuid
 from wsgiref.handlers import format_date_time as format_rfc1123_date
 
 from ...domain import DomainXML
-from ...generate import copy_memory
+from ...generate import MEMORY_COMPRESSION_FORMATS, copy_memory
 from ...memory import LibvirtQemuMemoryHeader, LibvirtQemuMemoryHeaderData
 from ...package import Package
 from ...source import source_open, SourceRange
 from ...util import (ErrorBuffer, ensure_dir, get_pristine_cache_dir,
-        get_modified_cache_dir, setup_libvirt)
+        get_modified_cache_dir, pwrite, rename, setup_libvirt)
 from .. import Controller, MachineExecutionError, MachineStateError, Statistic
+from .iteration import AdaptiveIterationPolicy, IterationScheduler
 from .monitor import (ChunkMapMonitor, LineStreamMonitor,
         CheckinProgressMonitor,
         BackgroundUploadMonitor,
@@ -70,6 +75,8 @@ LibvirtEventImpl().register()
 
 
 class _Image(object):
+    # Must match vmnetfs
+    CHUNKS_PER_DIR = 4096
 
     @staticmethod
     def get_pristine_cache_path(uuid):
@@ -90,8 +97,12 @@ class _Image(object):
                 return info['version']
 
     def __init__(self, label, range, username=None, password=None,
-            chunk_size=131072, stream=False, checkin=False, throttle_rate=1.0):
+            chunk_size=131072, stream=False, checkin=False, throttle_rate=1.0,
+            base=None):
         self.label = label
+        # _Image for the corresponding image of the base package, if this
+        # is a delta package
+        self.base = base
         self.username = username
         self.password = password
         self.stream = stream
@@ -105,6 +116,28 @@ class _Image(object):
         self.checkin = checkin
         self.throttle_rate = throttle_rate
 
+        # Record whether chunk fetches map to aligned ranges at the origin
+        self.alignment = getattr(range, 'alignment', None)
+        self.aligned = (self.offset % chunk_size == 0 and
+                bool(self.alignment) and self.alignment % chunk_size == 0)
+        if self.alignment and not self.aligned:
+            _log.warning('%s image alignment %d does not match chunk size %d',
+                    label, self.alignment, chunk_size)
+
+        # Per-chunk index from a version 2 package, if usable
+        self.chunks = getattr(range, 'chunks', None)
+        # Images stored as chunk frames exist only through the chunk
+        # index, so vmnetfs cannot fetch their chunks from the origin
+        self.chunked = getattr(range, 'chunked', False)
+        if self.chunks is not None and self.chunks.chunk_size != chunk_size:
+            if self.chunked:
+                raise MachineExecutionError('%s image is stored in chunks '
+                        'of %d bytes; expected %d' % (label,
+                        self.chunks.chunk_size, chunk_size))
+            _log.warning('Ignoring %s chunk index with chunk size %d',
+                    label, self.chunks.chunk_size)
+            self.chunks = None
+
         parsed_url = urlsplit(self.url)
         self._pristine_cache_info = json.dumps({
             # Exclude query string from cache path
@@ -148,6 +181,80 @@ class _Image(object):
             self.size = int(f.readline())
             f.close()
 
+    def _get_pristine_chunk_path(self, chunk):
+        return os.path.join(self.pristine_cache,
+                str(chunk // self.CHUNKS_PER_DIR * self.CHUNKS_PER_DIR),
+                str(chunk))
+
+    def _seed_pristine_cache(self):
+        '''Use the chunk index to populate the pristine cache with chunks
+        that need not be fetched: zero chunks, duplicates of chunks that
+        are already cached, and chunks unchanged from a base package that
+        are in its pristine cache.  If the image is stored as chunk
+        frames, vmnetfs cannot fetch any chunk, so every other chunk is
+        read through the chunk index, from this package or its base.
+        Base chunks read this way are also added to the base's pristine
+        cache.'''
+        if self.chunks is None:
+            return
+        seeded = 0
+        for chunk, info in enumerate(self.chunks.chunks):
+            path = self._get_pristine_chunk_path(chunk)
+            if os.path.exists(path):
+                continue
+            source = None
+            if info.base is not None:
+                if self.base is not None:
+                    source = self.base._get_pristine_chunk_path(info.base)
+            elif info.duplicate_of is not None:
+                source = self._get_pristine_chunk_path(info.duplicate_of)
+            if (not info.zero and not self.chunked and
+                    (source is None or not os.path.exists(source))):
+                continue
+            ensure_dir(os.path.dirname(path))
+            # vmnetfs ignores non-numeric names at the top level
+            temp = os.path.join(self.pristine_cache, 'seed.tmp')
+            if info.zero:
+                # Sparse file
+                with open(temp, 'w') as fh:
+                    fh.truncate(min(self.chunk_size,
+                            self.chunks.member.length -
+                            chunk * self.chunk_size))
+            elif source is not None and os.path.exists(source):
+                shutil.copyfile(source, temp)
+            else:
+                data = self.chunks.read(chunk)
+                with open(temp, 'w') as fh:
+                    fh.write(data)
+                if info.base is not None and source is not None:
+                    self.base._add_pristine_chunk(source, data)
+            rename(temp, path)
+            seeded += 1
+        if seeded:
+            _log.info('Seeded %d %s chunks from chunk index', seeded,
+                    self.label)
+
+    def _add_pristine_chunk(self, path, data):
+        ensure_dir(os.path.dirname(path))
+        temp = os.path.join(self.pristine_cache, 'seed.tmp')
+        with open(temp, 'w') as fh:
+            fh.write(data)
+        rename(temp, path)
+
+    def _check_chunks(self):
+        '''Ensure that vmnetfs can obtain every chunk, either from the
+        origin or from the pristine cache.'''
+        if not self.chunked:
+            return
+        if self.chunks is None:
+            raise MachineExecutionError('%s image has no chunk index' %
+                    self.label)
+        for chunk in xrange(len(self.chunks)):
+            if not os.path.exists(self._get_pristine_chunk_path(chunk)):
+                raise MachineExecutionError('Chunk %d of %s image cannot '
+                        'be fetched and is not cached' % (chunk,
+                        self.label))
+
     def get_recompressed_path(self, algorithm):
         return os.path.join(self._pristine_urlpath, self.label,
                 'recompressed.%s' % algorithm)
@@ -171,6 +278,9 @@ class _Image(object):
             with open(info_file, 'w') as fh:
                 fh.write(self._modified_cache_info)
 
+        self._seed_pristine_cache()
+        self._check_chunks()
+
         # Return XML image element
         e = ElementMaker(namespace=VMNETFS_NS, nsmap={None: VMNETFS_NS})
         origin = e.origin(
@@ -343,6 +453,10 @@ class _MemoryRecompressor(object):
     RECOMPRESSION_DELAY = 30000  # ms
 
     def __init__(self, controller, algorithm, in_path, out_path):
+        if (MEMORY_COMPRESSION_FORMATS[algorithm] not in
+                LibvirtQemuMemoryHeader.LIBVIRT_FORMATS):
+            raise ValueError('libvirt cannot restore %s memory images' %
+                    algorithm)
         self._algorithm = algorithm
         self._in_path = in_path
         self._out_path = out_path
@@ -383,8 +497,8 @@ class _MemoryRecompressor(object):
 
 
 # Called by process
-def _background_snapshot(order_queue):
-    qmp = QmpAfUnix(QMP_UNIX_SOCK)
+def _background_snapshot(order_queue, qmp_socket_path):
+    qmp = QmpAfUnix(qmp_socket_path)
     qmp.connect()
     ret = qmp.qmp_negotiate()
     if not ret:
@@ -421,6 +535,16 @@ def _save_to_fifo(input_fifo_path, domain_name):
     conn.close()
 
 class MemoryReadProcess(threading.Thread):
+    '''Read the page stream written by QEMU to the FIFO and apply each page
+    to the memory image.  Chunks of the image are cached in bytearrays,
+    and each incoming page is compared with the cached contents and
+    copied in place only if it differs, recording which pages of each
+    chunk are dirty.  Dirty pages are written back together, in file
+    order, when a new iteration starts, when a dirty chunk must be
+    evicted from the cache, and at the end of the stream.  Pages that
+    did not change are never written, so they do not cause vmnetfs to
+    mark their chunks modified and upload them.'''
+
     # header format for each memory page
     CHUNK_HEADER_FMT = "=Q"
     CHUNK_HEADER_SIZE = struct.calcsize("=Q")
@@ -429,34 +553,65 @@ class MemoryReadProcess(threading.Thread):
     CHUNK_POS_MASK   = (1 << ITER_SEQ_SHIFT) - 1
     ITER_SEQ_MASK   = ((1 << (CHUNK_HEADER_SIZE * 8)) - 1) - CHUNK_POS_MASK
     ALIGNED_HEADER_SIZE = 4096*2
-
-    def __init__(self, input_fifo_path, memory_image_path, chunk_size=131072):
+    PAGE_SIZE = 4096
+    _zero_page = '\0' * PAGE_SIZE
+    # Must cover the libvirt header and the QEMU snapshot size
+    HEADER_READ_SIZE = 4096*10
+    # Seconds without input after which dirty pages are written back
+    IDLE_FLUSH_DELAY = 0.1
+
+    def __init__(self, input_fifo_path, memory_image_path, chunk_size=131072,
+            cache_chunks=256, read_size=1 << 20):
+        if chunk_size % self.PAGE_SIZE:
+            raise ValueError('Chunk size must be a multiple of page size')
         self.input_fifo_path = input_fifo_path
         self.memory_image_path = memory_image_path
         self.iteration_seq = -1
         self.chunk_size = chunk_size
-        self.curr_chunk_num = 0
-        self.curr_chunk_buffer = ""
-        self.curr_chunk_offset = 0
+        self.cache_chunks = cache_chunks
+        self.read_size = max(read_size, self.HEADER_READ_SIZE,
+                2 * (self.CHUNK_HEADER_SIZE + self.PAGE_SIZE))
+        self.in_fd = None
+        self.out_fd = None
+        # chunk number -> bytearray, in LRU order
+        self._chunks = OrderedDict()
+        # chunk number -> bitmask of dirty pages, for dirty chunks
+        self._dirty = {}
+        # Counters
+        self._stats = {
+            'pages_received': 0,
+            'pages_changed': 0,
+            'zero_pages': 0,
+            'chunks_read': 0,
+            'chunks_dirtied': 0,
+        }
+        # record count -> Struct
+        self._record_structs = {}
         threading.Thread.__init__(self, target=self.read_mem_snapshot)
 
-    def process_header(self, mem_file_fd, output_fd):
-        data = mem_file_fd.read(4096*10)
+    @property
+    def stats(self):
+        '''Return a snapshot of the counters.  chunks_dirtied counts each
+        chunk once per write-back that changed it.'''
+        return dict(self._stats)
+
+    def process_header(self, data, output_fd):
+        '''Write the aligned libvirt header for the header data read from
+        the FIFO.  Return the domain XML, the snapshot size, and the number
+        of bytes of data consumed.'''
         libvirt_header = LibvirtQemuMemoryHeaderData(data)
         header = libvirt_header.get_header()
         header_size = len(header)
 
         # read 8 bytes of qemu header
-        snapshot_size_data = data[header_size:header_size+self.CHUNK_HEADER_SIZE]
-        snapshot_size, = struct.unpack(self.CHUNK_HEADER_FMT,
-                                       snapshot_size_data)
-        remaining_data = data[len(header)+self.CHUNK_HEADER_SIZE:]
+        snapshot_size, = struct.unpack_from(self.CHUNK_HEADER_FMT, data,
+                header_size)
 
         # write aligned header (8KB) to file
         aligned_header = libvirt_header.get_aligned_header(self.ALIGNED_HEADER_SIZE)
         output_fd.write(aligned_header)
-        self.debug = open('/home/dayoon/senior/debug/process', 'w')
-        return libvirt_header.xml, snapshot_size, remaining_data
+        return (libvirt_header.xml, snapshot_size,
+                header_size + self.CHUNK_HEADER_SIZE)
 
     def read_mem_snapshot(self):
         # waiting for named pipe
@@ -468,99 +623,183 @@ class MemoryReadProcess(threading.Thread):
 
         # read memory snapshot from the named pipe
         try:
-            self.in_fd = open(self.input_fifo_path, 'rb')
-            self.out_fd = open(self.memory_image_path, 'r+b')
+            # Raw FileIO, so that readinto() fills our buffer directly and
+            # returns whatever the FIFO has rather than waiting for the
+            # whole buffer.  The image is unbuffered so that chunk reads
+            # see our pwrite()s.
+            self.in_fd = io.open(self.input_fifo_path, 'rb', buffering=0)
+            self.out_fd = open(self.memory_image_path, 'r+b', 0)
 
-            input_fd = [self.in_fd]
+            buf = bytearray(self.read_size)
+            view = memoryview(buf)
 
             # skip libvirt header
-            header_xml, snapshot_size, remaining_data =\
-                self.process_header(self.in_fd, self.out_fd)
+            end = self._read_fully(view[:self.HEADER_READ_SIZE])
+            header_xml, snapshot_size, pos = \
+                self.process_header(str(buf[:end]), self.out_fd)
 
             # remaining data are all about memory page
             # [(8 bytes header, 4KB page), (8 bytes header, 4KB page), ...]
-            self.out_fd.seek(0)
-            self.curr_chunk_buffer = self.out_fd.read(self.chunk_size)
-
-            chunk_size = self.CHUNK_HEADER_SIZE + 4096
-            leftover = self._data_chunking(remaining_data, chunk_size)
             while True:
-                data = self.in_fd.read(10*4096)
-                if not data:
+                pos = self._process_pages(buf, view, pos, end)
+                # Move the partial record to the start of the buffer.
+                # Once a record has been consumed, pos is larger than the
+                # partial record, so the copy cannot overlap.
+                leftover = end - pos
+                if leftover and pos:
+                    view[:leftover] = view[pos:end]
+                pos = 0
+                # If QEMU has paused between iterations, write back now
+                # so the pages can be uploaded before the next one
+                if self._dirty and not select.select([self.in_fd], [], [],
+                        self.IDLE_FLUSH_DELAY)[0]:
+                    self._flush()
+                count = self.in_fd.readinto(view[leftover:])
+                if not count:
                     break
-                leftover = self._data_chunking(leftover+data, chunk_size)
-
-            # write whats left in the buffer
-            memory_image_offset = self.curr_chunk_num * self.chunk_size
-            self.out_fd.seek(memory_image_offset)
-            data_binary = struct.pack('%ds' % self.chunk_size,
-                    self.curr_chunk_buffer)
-            self.out_fd.write(data_binary)
-
-        except Exception, e:
-            sys.stdout.write("[MemorySnapshotting] Exception1n")
-            # sys.stderr.write(traceback.format_exc())
-            sys.stderr.write("%s\n" % str(e))
+                end = leftover + count
+
+            # write whats left in the cache
+            self._flush()
+            _log.info('Memory snapshot: %(pages_received)d pages received, '
+                    '%(pages_changed)d changed, %(zero_pages)d zero; '
+                    '%(chunks_dirtied)d chunks dirtied', self._stats)
+
+        except Exception:
+            _log.exception('Reading memory snapshot failed')
         self.finish()
 
-    def _data_chunking(self, l, n):
-        leftover = ''
-        for index in range(0, len(l), n):
-            chunked_data = l[index:index+n]
-            chunked_data_size = len(chunked_data)
-            if chunked_data_size == n:
-                header = chunked_data[0:self.CHUNK_HEADER_SIZE]
-                header_data, = struct.unpack(self.CHUNK_HEADER_FMT, header)
-                iter_seq = (header_data& self.ITER_SEQ_MASK) >> self.ITER_SEQ_SHIFT
-                ram_offset = (header_data & self.CHUNK_POS_MASK)
-                if iter_seq != self.iteration_seq:
-                    self.iteration_seq = iter_seq
-
-                # save the snapshot data
-                memory_image_offset = ram_offset + self.ALIGNED_HEADER_SIZE
-
-                # THIS WORKS
-                # self.out_fd.seek(memory_image_offset)
-                # self.out_fd.write(chunked_data[self.CHUNK_HEADER_SIZE:])
-
-                chunk_num = memory_image_offset / self.chunk_size
-
-                # All the pages for the last chunk have been written to the pipe
-                if chunk_num != self.curr_chunk_num:
-                    self.out_fd.seek(self.curr_chunk_offset)
-                    data_binary = struct.pack('%ds' % self.chunk_size,
-                            self.curr_chunk_buffer)
-                    self.out_fd.write(data_binary)
-
-                    self.debug.write('wrote chunk %d of len %d %d at %d \n' %
-                            (self.curr_chunk_num,
-                        len(data_binary), len(self.curr_chunk_buffer),
-                        self.curr_chunk_offset))
-
-                    self.curr_chunk_num = chunk_num
-                    self.curr_chunk_offset = self.curr_chunk_num * self.chunk_size
-
-                    # Read in new chunk that will be updated
-                    self.out_fd.seek(self.curr_chunk_offset)
-                    self.curr_chunk_buffer = self.out_fd.read(self.chunk_size)
-
-                # offset within a chunk
-                page_offset = memory_image_offset % self.chunk_size
-                page_size = len(chunked_data[self.CHUNK_HEADER_SIZE:])
-
-                # Strings in python are immutable so generate a new string
-                self.curr_chunk_buffer = \
-                        self.curr_chunk_buffer[:page_offset] + \
-                        chunked_data[self.CHUNK_HEADER_SIZE:] + \
-                        self.curr_chunk_buffer[page_offset+page_size:]
+    def _read_fully(self, view):
+        '''Read into memoryview view until it is full or the FIFO reaches
+        EOF.  Return the number of bytes read.'''
+        pos = 0
+        while pos < len(view):
+            count = self.in_fd.readinto(view[pos:])
+            if not count:
+                break
+            pos += count
+        return pos
+
+    def _record_struct(self, count):
+        '''Return a Struct decoding the headers of count consecutive page
+        records in one call, skipping the page data.'''
+        record_struct = self._record_structs.get(count)
+        if record_struct is None:
+            record_struct = struct.Struct(self.CHUNK_HEADER_FMT[0] +
+                    (self.CHUNK_HEADER_FMT[1:] + '%dx' % self.PAGE_SIZE) *
+                    count)
+            self._record_structs[count] = record_struct
+        return record_struct
+
+    def _process_pages(self, buf, view, pos, end):
+        '''Apply the complete page records in buf between pos and end.
+        Return the offset of the first unprocessed byte.'''
+        header_size = self.CHUNK_HEADER_SIZE
+        page_size = self.PAGE_SIZE
+        record_size = header_size + page_size
+        count = (end - pos) // record_size
+        if not count:
+            return pos
+
+        # Decode all headers in the window at once
+        headers = self._record_struct(count).unpack_from(buf, pos)
+        iter_seqs = [(header & self.ITER_SEQ_MASK) >> self.ITER_SEQ_SHIFT
+                for header in headers]
+        offsets = [(header & self.CHUNK_POS_MASK) + self.ALIGNED_HEADER_SIZE
+                for header in headers]
+        if any(offset % page_size for offset in offsets):
+            raise ValueError('Unaligned page offset')
+        chunk_nums = [offset // self.chunk_size for offset in offsets]
+
+        # Apply runs of pages from the same iteration to the same chunk
+        dirty = self._dirty
+        zero_page = self._zero_page
+        changed = 0
+        zero = 0
+        i = 0
+        while i < count:
+            iter_seq = iter_seqs[i]
+            if iter_seq != self.iteration_seq:
+                # Write back the previous iteration
+                self._flush()
+                self.iteration_seq = iter_seq
+            chunk_num = chunk_nums[i]
+            chunk_start = chunk_num * self.chunk_size
+            chunk = memoryview(self._get_chunk(chunk_num))
+            mask = 0
+            while (i < count and chunk_nums[i] == chunk_num and
+                    iter_seqs[i] == iter_seq):
+                chunk_offset = offsets[i] - chunk_start
+                page = pos + i * record_size + header_size
+                data = view[page:page + page_size]
+                if data == zero_page:
+                    zero += 1
+                if chunk[chunk_offset:chunk_offset + page_size] != data:
+                    chunk[chunk_offset:chunk_offset + page_size] = data
+                    mask |= 1 << (chunk_offset // page_size)
+                    changed += 1
+                i += 1
+            if mask:
+                dirty[chunk_num] = dirty.get(chunk_num, 0) | mask
+        self._stats['pages_received'] += count
+        self._stats['pages_changed'] += changed
+        self._stats['zero_pages'] += zero
+        return pos + count * record_size
+
+    def _get_chunk(self, chunk_num):
+        '''Return the cached contents of a chunk, reading it from the
+        image if necessary.'''
+        chunk = self._chunks.pop(chunk_num, None)
+        if chunk is None:
+            if len(self._chunks) >= self.cache_chunks:
+                if next(iter(self._chunks)) in self._dirty:
+                    self._flush()
+                # Reuse the buffer of the least recently used chunk
+                _, chunk = self._chunks.popitem(last=False)
             else:
-                # last iteration
-                leftover = chunked_data
-        return leftover
+                chunk = bytearray(self.chunk_size)
+            self.out_fd.seek(chunk_num * self.chunk_size)
+            length = 0
+            while length < self.chunk_size:
+                count = self.out_fd.readinto(memoryview(chunk)[length:])
+                if not count:
+                    # Past the end of the image
+                    chunk[length:] = bytearray(self.chunk_size - length)
+                    break
+                length += count
+            self._stats['chunks_read'] += 1
+        self._chunks[chunk_num] = chunk
+        return chunk
+
+    def _flush(self):
+        '''Write back the dirty pages of all cached chunks, in file
+        order, coalescing adjacent pages.  The chunks remain cached.'''
+        fd = self.out_fd.fileno()
+        page_size = self.PAGE_SIZE
+        for chunk_num in sorted(self._dirty):
+            chunk = self._chunks[chunk_num]
+            mask = self._dirty[chunk_num]
+            page = 0
+            while mask:
+                while not mask & 1:
+                    mask >>= 1
+                    page += 1
+                count = 0
+                while mask & 1:
+                    mask >>= 1
+                    count += 1
+                pwrite(fd, chunk, count * page_size,
+                        chunk_num * self.chunk_size + page * page_size,
+                        page * page_size)
+                page += count
+        self._stats['chunks_dirtied'] += len(self._dirty)
+        self._dirty.clear()
 
     def finish(self):
-        self.out_fd.close()
-        self.debug.close()
+        if self.out_fd is not None:
+            self.out_fd.close()
+        if self.in_fd is not None:
+            self.in_fd.close()
 
 
 class LocalController(Controller):
@@ -569,17 +808,30 @@ class LocalController(Controller):
     AUTHORIZER_IFACE = 'org.olivearchive.VMNetX.Authorizer'
     STATS = ('bytes_read', 'bytes_written', 'chunk_dirties', 'chunk_fetches',
             'io_errors')
+    # Any format accepted by copy_memory() that libvirt can restore.  zstd
+    # and lz4 are private to VMNetX and cannot be used.
     RECOMPRESSION_ALGORITHM = 'lzop'
+    # Live memory snapshot iteration scheduling.  The policy is an
+    # IterationPolicy subclass, called with no arguments; its choices are
+    # clamped to the interval bounds, in seconds.
+    ITERATION_POLICY = AdaptiveIterationPolicy
+    ITERATION_MIN_INTERVAL = 5
+    ITERATION_MAX_INTERVAL = 300
+    # Time allowed for QEMU to make page output sequential
+    ITERATION_START_DELAY = 60
     _environment_ready = False
 
     def __init__(self, url=None, package=None, use_spice=True,
-            viewer_password=None, checkin=False, throttle_rate=1.0):
+            viewer_password=None, checkin=False, throttle_rate=1.0,
+            secret_key=None):
         Controller.__init__(self)
         self._url = url
+        self._secret_key = secret_key
         self._want_spice = use_spice
         self._domain_name = 'vmnetx-%d-%s' % (os.getpid(), uuid.uuid4())
         self._package = package
         self._have_memory = False
+        self._memory_path = None
         self._memory_image_path = None
         self._fs = None
         self._conn = None
@@ -605,7 +857,13 @@ class LocalController(Controller):
         self._p = None # background snapshot process
         self._t = None
         self._fifo_process = None
-        self._iteration_interval = 20
+        # Private directory for the QMP socket and snapshot FIFO, so that
+        # instances on the same host do not collide
+        self._runtime_dir = None
+        self._qmp_socket_path = None
+        self._iteration_scheduler = IterationScheduler(
+                self.ITERATION_POLICY(), self.ITERATION_MIN_INTERVAL,
+                self.ITERATION_MAX_INTERVAL)
 
     @Controller._ensure_state(Controller.STATE_UNINITIALIZED)
     def initialize(self):
@@ -616,10 +874,13 @@ class LocalController(Controller):
         # Load package
         if self._package is None:
             source = source_open(self._url, scheme=self.scheme,
-                    username=self.username, password=self.password)
+                    username=self.username, password=self.password,
+                    secret_key=self._secret_key)
             package = Package(source)
         else:
             package = self._package
+        base = package.load_base(scheme=self.scheme,
+                username=self.username, password=self.password)
 
         # Validate domain XML
         domain_xml = DomainXML(package.domain.data)
@@ -630,12 +891,16 @@ class LocalController(Controller):
         vmnetfs_config.append(_Image('disk', package.disk,
                 username=self.username, password=self.password,
                 checkin=self._checkin,
-                throttle_rate=self._throttle_rate).vmnetfs_config)
+                throttle_rate=self._throttle_rate,
+                base=_Image('disk', base.disk)
+                if base is not None else None).vmnetfs_config)
         if package.memory:
             image = _Image('memory', package.memory, username=self.username,
                     password=self.password, stream=True,
                     checkin=self._checkin,
-                    throttle_rate=self._throttle_rate)
+                    throttle_rate=self._throttle_rate,
+                    base=_Image('memory', base.memory)
+                    if base is not None and base.memory else None)
             self._modified_memory = image.modified_cache
             # Use recompressed memory image if available
             '''
@@ -669,7 +934,8 @@ class LocalController(Controller):
                         self._memory_image_path, recompressed_path)
                         '''
         else:
-            memory_path = self._memory_image_path = None
+            memory_path = self._memory_path = None
+            self._memory_image_path = None
 
         # Set up libvirt connection
         if not self._checkin:
@@ -691,19 +957,34 @@ class LocalController(Controller):
                 self.viewer_password = base64.urlsafe_b64encode(os.urandom(
                         15 if self.use_spice else 6))
 
+            # Create per-instance QMP socket path
+            self._runtime_dir = mkdtemp(prefix='vmnetx-')
+            self._qmp_socket_path = os.path.join(self._runtime_dir,
+                    'qmp.sock')
+
             # Get execution domain XML
             self._domain_xml = domain_xml.get_for_execution(self._domain_name,
                     emulator, disk_image_path, self.viewer_password,
                     use_spice=self.use_spice,
-                    allow_qxl=False).xml
+                    allow_qxl=False,
+                    qmp_socket_path=self._qmp_socket_path).xml
                     #allow_qxl=self._qxl_is_usable(emulator)).xml
 
             # Write domain XML to memory image
             if self._memory_image_path is not None:
                 with open(self._memory_image_path, 'r+') as fh:
                     hdr = LibvirtQemuMemoryHeader(fh)
-                    hdr.xml = self._domain_xml
-                    hdr.write(fh)
+                    if hdr.libvirt_compatible:
+                        hdr.xml = self._domain_xml
+                        hdr.write(fh)
+                    else:
+                        # Never hand a VMNetX-private format to libvirt
+                        compressed = hdr.compressed
+                        gobject.idle_add(lambda: _log.warning('Ignoring '
+                                'memory image in format %d, which libvirt '
+                                'cannot restore', compressed))
+                        memory_path = self._memory_path = None
+                        self._memory_image_path = None
 
         # Set configuration
         self.vm_name = package.name
@@ -866,7 +1147,10 @@ class LocalController(Controller):
                                 libvirt.VIR_DOMAIN_SAVE_RUNNING)
 
                         # Initialize background process to order snapshots
-                        self._p = multiprocessing.Process(target=_background_snapshot, args=(self._order_queue,))
+                        self._p = multiprocessing.Process(
+                                target=_background_snapshot,
+                                args=(self._order_queue,
+                                self._qmp_socket_path))
                         self._p.start()
 
                         # Start sending iteration requests
@@ -875,7 +1159,7 @@ class LocalController(Controller):
                         self._order_thread.start()
 
                         # Create fifo
-                        output_fifo = os.path.join(self._modified_memory,
+                        output_fifo = os.path.join(self._runtime_dir,
                                 'output.fifo')
                         if os.path.exists(output_fifo) == True:
                             os.remove(output_fifo)
@@ -945,8 +1229,15 @@ class LocalController(Controller):
             self.emit('startup-progress', count, total)
 
     def _background_upload(self, _obj, disk_total, memory_total):
+        self._iteration_scheduler.update_backlog(disk_total + memory_total)
         self.emit('background-upload', disk_total, memory_total)
 
+    @property
+    def iteration_stats(self):
+        '''Return the signals and decision of the most recent live
+        snapshot scheduling round.'''
+        return self._iteration_scheduler.stats
+
     def connect_viewer(self, callback):
         if self.state != self.STATE_RUNNING:
             callback(error='Machine in inappropriate state')
@@ -971,15 +1262,37 @@ class LocalController(Controller):
 
     def _order_iterations(self):
         # Give time to process unrandomize
-        time.sleep(60)
+        if not self._wait_for_iteration(self.ITERATION_START_DELAY):
+            return
+
+        scheduler = self._iteration_scheduler
+        while True:
+            reader = self._t
+            interval = scheduler.next_interval(
+                    reader.stats if reader else {},
+                    reader.iteration_seq if reader else None)
+            if scheduler.pending:
+                _log.debug('Previous memory iteration not started; next '
+                        'check in %.0f s', interval)
+            else:
+                self._order_queue.put('iterate')
+                _log.debug('Requested memory iteration; next in %.0f s',
+                        interval)
+            if not self._wait_for_iteration(interval):
+                return
 
+    def _wait_for_iteration(self, interval):
+        '''Wait interval seconds.  If the VM is stopped first, tell the
+        snapshot process to stop and return False.'''
+        deadline = time.time() + interval
         while True:
-            for i in range(self._iteration_interval):
-                time.sleep(1)
-                if self.state == Controller.STATE_STOPPING:
-                    self._order_queue.put('stop')
-                    return
-            self._order_queue.put('iterate')
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, 1))
+            if self.state == Controller.STATE_STOPPING:
+                self._order_queue.put('stop')
+                return False
 
     def stop_vm(self):
         if (self.state == self.STATE_STARTING or
@@ -1021,6 +1334,11 @@ class LocalController(Controller):
         self.stop_vm()
         if self._stop_thread is not None:
             self._stop_thread.join()
+        # Snapshot processes that outlived the VM
+        for process in self._p, self._fifo_process:
+            if process is not None and process.is_alive():
+                process.terminate()
+                process.join()
         # Close libvirt connection
         if self._conn is not None:
             # We must deregister callbacks or the conn won't fully close
@@ -1033,5 +1351,9 @@ class LocalController(Controller):
         if self._fs is not None:
             self._fs.terminate()
             self._fs = None
+        # Remove QMP socket and snapshot FIFO
+        if self._runtime_dir is not None:
+            shutil.rmtree(self._runtime_dir, ignore_errors=True)
+            self._runtime_dir = None
         self.state = self.STATE_DESTROYED
 gobject.type_register(LocalController)
@@ -0,0 +1,188 @@
+#
+# vmnetx.controller.local.iteration - Live memory snapshot scheduling
+#
+# Copyright (C) 2015 Carnegie Mellon University
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of version 2 of the GNU General Public License as published
+# by the Free Software Foundation.  A copy of the GNU General Public License
+# should have been distributed along with this program in the file
+# COPYING.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+
+from __future__ import division
+from collections import namedtuple
+import threading
+import time
+
+# What a policy knows when choosing the next interval.  interval is the
+# previous interval in seconds; pages, changed, and chunks are the pages
+# received, pages changed, and chunks dirtied by the memory snapshot
+# during it; pending is True if QEMU has not yet started sending the
+# iteration requested at its start, in which case no new iteration will
+# be requested, or False if that is unknown; backlog is the number of
+# bytes waiting for background upload; upload_rate is the estimated
+# upload bandwidth in bytes/second, or None if unknown.
+IterationSignals = namedtuple('IterationSignals', ('interval', 'pages',
+        'changed', 'chunks', 'pending', 'backlog', 'upload_rate'))
+
+
+class IterationPolicy(object):
+    '''Chooses the number of seconds until the next snapshot iteration.
+    The result is clamped by IterationScheduler.'''
+
+    def next_interval(self, signals):
+        raise NotImplementedError()
+
+
+class FixedIterationPolicy(IterationPolicy):
+    '''Iterate every interval seconds.'''
+
+    def __init__(self, interval=20):
+        self.interval = interval
+
+    def next_interval(self, signals):
+        return self.interval
+
+
+class AdaptiveIterationPolicy(IterationPolicy):
+    '''Iterate every interval seconds, unless the upload path cannot keep
+    up.  Waits until the upload backlog is expected to drain, and long
+    enough to upload as many chunks as the previous iteration dirtied.
+    Backs off exponentially while the guest changes nothing, or while
+    QEMU has not started the previous iteration.'''
+
+    def __init__(self, interval=20, chunk_size=131072):
+        self.interval = interval
+        self.chunk_size = chunk_size
+
+    def next_interval(self, signals):
+        if signals.pending or (signals.pages and not signals.changed):
+            return signals.interval * 2
+        interval = self.interval
+        if signals.upload_rate:
+            interval = max(interval,
+                    signals.backlog / signals.upload_rate,
+                    signals.chunks * self.chunk_size / signals.upload_rate)
+        return interval
+
+
+class IterationScheduler(object):
+    '''Tracks the signals used by an IterationPolicy and applies the policy,
+    bounded by min_interval and max_interval.  An iteration that has not
+    started within max_interval of being requested is no longer
+    considered pending, so a stalled iteration sequence cannot stop
+    iterations for good.  update_backlog() can be called from any
+    thread.'''
+
+    # Weight of the newest upload rate sample
+    RATE_SMOOTHING = 0.3
+
+    def __init__(self, policy, min_interval=5, max_interval=300):
+        self.policy = policy
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._lock = threading.Lock()
+        self._backlog = 0
+        self._drained = 0
+        self._upload_rate = None
+        self._interval = None
+        self._last_time = None
+        self._last_counts = None
+        self._last_seq = None
+        # When the last iteration was requested or seen to start
+        self._seq_time = None
+        self._stats = {
+            'rounds': 0,
+            'interval': None,
+            'backlog': 0,
+            'upload_rate': None,
+            'pages': 0,
+            'changed': 0,
+            'chunks': 0,
+            'pending': False,
+        }
+
+    @property
+    def stats(self):
+        '''Return a snapshot of the signals and decision of the most recent
+        scheduling round.'''
+        with self._lock:
+            return dict(self._stats)
+
+    @property
+    def pending(self):
+        '''True if the iteration requested after the previous scheduling
+        round has not started, so another should not be requested.'''
+        with self._lock:
+            return self._stats['pending']
+
+    def update_backlog(self, backlog):
+        '''Record the current upload backlog in bytes.  Decreases are
+        counted as uploaded data.'''
+        with self._lock:
+            if backlog < self._backlog:
+                self._drained += self._backlog - backlog
+            self._backlog = backlog
+
+    def next_interval(self, counts, iteration_seq):
+        '''Return the number of seconds until the next iteration should be
+        requested.  counts is a dict of cumulative pages_received,
+        pages_changed, and chunks_dirtied counters from the memory
+        snapshot reader, and iteration_seq is the iteration it is
+        receiving, or None if unknown.'''
+        now = time.time()
+        with self._lock:
+            if self._last_time is None:
+                elapsed = None
+                deltas = dict((name, 0) for name in counts)
+            else:
+                elapsed = now - self._last_time
+                deltas = dict((name,
+                        counts[name] - self._last_counts.get(name, 0))
+                        for name in counts)
+                if elapsed > 0 and (self._drained or self._backlog):
+                    sample = self._drained / elapsed
+                    if self._upload_rate is None:
+                        self._upload_rate = sample
+                    else:
+                        self._upload_rate = (self.RATE_SMOOTHING * sample +
+                                (1 - self.RATE_SMOOTHING) *
+                                self._upload_rate)
+            self._drained = 0
+            signals = IterationSignals(
+                interval=self._interval or self.min_interval,
+                pages=deltas.get('pages_received', 0),
+                changed=deltas.get('pages_changed', 0),
+                chunks=deltas.get('chunks_dirtied', 0),
+                pending=(iteration_seq is not None and
+                        iteration_seq == self._last_seq and
+                        now - self._seq_time < self.max_interval),
+                backlog=self._backlog,
+                upload_rate=self._upload_rate,
+            )
+            interval = self.policy.next_interval(signals)
+            interval = min(max(interval, self.min_interval),
+                    self.max_interval)
+            self._interval = interval
+            self._last_time = now
+            self._last_counts = dict(counts)
+            self._last_seq = iteration_seq
+            if not signals.pending:
+                self._seq_time = now
+            self._stats.update({
+                'rounds': self._stats['rounds'] + 1,
+                'interval': interval,
+                'backlog': signals.backlog,
+                'upload_rate': signals.upload_rate,
+                'pages': signals.pages,
+                'changed': signals.changed,
+                'chunks': signals.chunks,
+                'pending': signals.pending,
+            })
+            return interval
@@ -266,10 +266,11 @@ class BackgroundUploadMonitor(_Monitor):
     }
 
     def __init__(self, disk_path, memory_path):
+        # memory_path may be None if the VM has no usable memory image
         _Monitor.__init__(self)
         self._disk_chunk_size = self._read_stat(disk_path, 'chunk_size')
-        self._memory_chunk_size = self._read_stat(memory_path, 'chunk_size')
         self._disk_chunks = 0
+        self._memory_chunk_size = 0
         self._memory_chunks = 0
 
         reporter = Statistic('chunks')
@@ -277,10 +278,15 @@ class BackgroundUploadMonitor(_Monitor):
         self._disk_monitor = StatMonitor(reporter, disk_path,
                 'chunks_modified_not_uploaded')
 
-        reporter = Statistic('chunks')
-        reporter.connect('stat-changed', self._modify_memory)
-        self._memory_monitor = StatMonitor(reporter, memory_path,
-                'chunks_modified_not_uploaded')
+        if memory_path is not None:
+            self._memory_chunk_size = self._read_stat(memory_path,
+                    'chunk_size')
+            reporter = Statistic('chunks')
+            reporter.connect('stat-changed', self._modify_memory)
+            self._memory_monitor = StatMonitor(reporter, memory_path,
+                    'chunks_modified_not_uploaded')
+        else:
+            self._memory_monitor = None
 
     def _read_stat(self, image_path, name):
         path = os.path.join(image_path, 'stats', name)
@@ -302,5 +308,6 @@ class BackgroundUploadMonitor(_Monitor):
 
     def close(self):
         self._disk_monitor.close()
-        self._memory_monitor.close()
+        if self._memory_monitor is not None:
+            self._memory_monitor.close()
 gobject.type_register(BackgroundUploadMonitor)
@@ -19,8 +19,6 @@ import socket
 import json
 import time
 
-QMP_UNIX_SOCK = "/tmp/qmp_cloudlet"
-
 class QmpAfUnix:
     def __init__(self, s_name):
         self.s_name = s_name
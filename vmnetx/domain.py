@@ -31,6 +31,10 @@ from .util import DetailException
 NS = 'http://olivearchive.org/xmlns/vmnetx/domain-metadata'
 NSP = '{' + NS + '}'
 
+# libvirt QEMU command-line passthrough
+QEMU_NS = 'http://libvirt.org/schemas/domain/qemu/1.0'
+QEMU_NSP = '{' + QEMU_NS + '}'
+
 SAFE_SCHEMA_PATH = os.path.join(schemadir, 'domain.xsd')
 STRICT_SCHEMA_PATH = os.path.join(schemadir, 'libvirt', 'domain.rng')
 
@@ -105,6 +109,25 @@ class DomainXML(object):
         return etree.tostring(tree, pretty_print=True, encoding='UTF-8',
                 xml_declaration=True)
 
+    @classmethod
+    def _set_qmp_socket(cls, tree, path):
+        domain_node = cls._xpath_one(tree, '/domain')
+        cmdlines = domain_node.findall(QEMU_NSP + 'commandline')
+        if cmdlines:
+            cmdline = cmdlines[0]
+        else:
+            cmdline = etree.SubElement(domain_node,
+                    QEMU_NSP + 'commandline', nsmap={'qemu': QEMU_NS})
+        args = cmdline.findall(QEMU_NSP + 'arg')
+        remove = []
+        for arg, value in zip(args, args[1:]):
+            if arg.get('value') == '-qmp' and arg not in remove:
+                remove.extend((arg, value))
+        for arg in remove:
+            cmdline.remove(arg)
+        for value in '-qmp', 'unix:%s,server,nowait' % path:
+            etree.SubElement(cmdline, QEMU_NSP + 'arg', value=value)
+
     @classmethod
     def _remove_metadata(cls, tree):
         # Strip <metadata> element, which is not supported by libvirt < 0.9.10
@@ -187,7 +210,10 @@ class DomainXML(object):
                 etree.fromstring(self.xml)).path
 
     def get_for_execution(self, name, emulator, disk_image_path,
-            viewer_password, use_spice=True, allow_qxl=True):
+            viewer_password, use_spice=True, allow_qxl=True,
+            qmp_socket_path=None):
+        '''If qmp_socket_path is specified, replace any QMP monitors given
+        on the QEMU command line with a QMP server socket at that path.'''
         # Parse XML
         tree = etree.fromstring(self.xml)
 
@@ -239,6 +265,10 @@ class DomainXML(object):
         #         not allow_qxl):
         video_model.set('type', 'cirrus')
 
+        # Give this instance its own QMP socket
+        if qmp_socket_path is not None:
+            self._set_qmp_socket(tree, qmp_socket_path)
+
         # Return new instance
         return type(self)(self._to_xml(tree), safe=False)
 
@@ -16,37 +16,243 @@
 #
 
 from __future__ import division
+from collections import deque
 from contextlib import closing
 import libvirt
+import multiprocessing
 import os
+import re
+from StringIO import StringIO
 import subprocess
 import sys
 from tempfile import NamedTemporaryFile
+import threading
+import time
+from urlparse import urlsplit
 
 from .domain import DomainXML, DomainXMLError
 from .memory import LibvirtQemuMemoryHeader
-from .package import Package
-from .source import source_open
+from .package import BadPackageError, Package
+from .source import SourceError, source_open
 from .util import DetailException
 
+MEMORY_COMPRESSION_FORMATS = {
+    None: LibvirtQemuMemoryHeader.COMPRESS_RAW,
+    'xz': LibvirtQemuMemoryHeader.COMPRESS_XZ,
+    'lzop': LibvirtQemuMemoryHeader.COMPRESS_LZOP,
+    'zstd': LibvirtQemuMemoryHeader.COMPRESS_ZSTD,
+    'lz4': LibvirtQemuMemoryHeader.COMPRESS_LZ4,
+}
 MEMORY_COMPRESS_COMMANDS = {
     LibvirtQemuMemoryHeader.COMPRESS_RAW: None,
     LibvirtQemuMemoryHeader.COMPRESS_XZ: ('xz', '-9c'),
     LibvirtQemuMemoryHeader.COMPRESS_LZOP: ('lzop', '-c'),
+    LibvirtQemuMemoryHeader.COMPRESS_ZSTD: ('zstd', '-19qc'),
+    LibvirtQemuMemoryHeader.COMPRESS_LZ4: ('lz4', '-9qc'),
 }
 MEMORY_DECOMPRESS_COMMANDS = {
     LibvirtQemuMemoryHeader.COMPRESS_RAW: None,
     LibvirtQemuMemoryHeader.COMPRESS_XZ: ('xz', '-dc'),
     LibvirtQemuMemoryHeader.COMPRESS_LZOP: ('lzop', '-dc', '--ignore-warn'),
+    LibvirtQemuMemoryHeader.COMPRESS_ZSTD: ('zstd', '-dqc'),
+    LibvirtQemuMemoryHeader.COMPRESS_LZ4: ('lz4', '-dqc'),
+}
+# Formats whose decompressors accept concatenated streams, so that blocks
+# of the memory image can be compressed independently and in parallel.
+# The dictionary need not be larger than a block.
+MEMORY_BLOCK_SIZE = 32 << 20
+MEMORY_BLOCK_COMPRESS_COMMANDS = {
+    LibvirtQemuMemoryHeader.COMPRESS_XZ: ('xz', '-c',
+            '--lzma2=preset=9,dict=%d' % MEMORY_BLOCK_SIZE),
+    LibvirtQemuMemoryHeader.COMPRESS_ZSTD: ('zstd', '-19qc'),
+    LibvirtQemuMemoryHeader.COMPRESS_LZ4: ('lz4', '-9qc'),
 }
+# Default limit on concurrent block compressors.  Each xz compressor needs
+# about 350 MB, plus an input and output block held in memory.
+MEMORY_BLOCK_DEFAULT_THREADS = 4
 
 
 class MachineGenerationError(DetailException):
     pass
 
 
+class _Progress(object):
+    '''A single progress line combining several concurrent jobs.'''
+
+    def __init__(self, labels):
+        self._labels = labels
+        self._percent = dict((label, 0) for label in labels)
+        self._lock = threading.Lock()
+
+    def callback(self, label):
+        '''Return a function accepting a count and total, which updates
+        the progress of the specified job.'''
+        def update(count, total):
+            percent = 100 * count // total if total else 100
+            with self._lock:
+                if percent == self._percent[label]:
+                    return
+                self._percent[label] = percent
+                print '\r' + '  '.join('%s: %3d%%' % (label,
+                        self._percent[label]) for label in self._labels),
+                sys.stdout.flush()
+        return update
+
+    def finish(self):
+        print
+
+
+class _Job(object):
+    '''Run a function in a background thread.'''
+
+    def __init__(self, name, target, *args, **kwargs):
+        self._target = target
+        self._exc_info = None
+        self._thread = threading.Thread(name=name, target=self._run,
+                args=args, kwargs=kwargs)
+        self._thread.start()
+
+    def _run(self, *args, **kwargs):
+        try:
+            self._target(*args, **kwargs)
+        # Reraised in wait()
+        # pylint: disable=broad-except
+        except Exception:
+            self._exc_info = sys.exc_info()
+        # pylint: enable=broad-except
+
+    def wait(self):
+        '''Wait for the function to return and reraise any error.'''
+        self._thread.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+
+class _PendingFile(object):
+    '''A readable file object for the output of a _Job, which blocks
+    until the job has finished when first read.'''
+
+    def __init__(self, job, path):
+        self._job = job
+        self._path = path
+        self._fh = None
+
+    def read(self, size=-1):
+        if self._fh is None:
+            self._job.wait()
+            self._fh = open(self._path, 'rb')
+        return self._fh.read(size)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+
+
+class _BlockCompressor(object):
+    '''A writable file object that splits its input into blocks,
+    compresses each one with a separate run of command on a pool of
+    threads, and writes the compressed blocks to fout in order.  fout is
+    closed by close().'''
+
+    def __init__(self, command, fout, threads,
+            block_size=MEMORY_BLOCK_SIZE):
+        self._command = command
+        self._fout = fout
+        self._threads = threads
+        self._block_size = block_size
+        self._buf = []
+        self._buf_len = 0
+        # Blocks in submission order: [event, compressed data, exc_info]
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._queue = deque()
+        self._workers = []
+        self._closing = False
+        self._exc_info = None
+        for i in range(threads):
+            thread = threading.Thread(name='vmnetx-compress-%d' % i,
+                    target=self._worker)
+            thread.start()
+            self._workers.append(thread)
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closing:
+                    self._ready.wait()
+                if not self._queue:
+                    return
+                data, block = self._queue.popleft()
+            try:
+                proc = subprocess.Popen(self._command,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        close_fds=True)
+                out, _ = proc.communicate(data)
+                if proc.returncode:
+                    raise IOError('Compressor failed')
+                block[1] = out
+            # Reraised in the writing thread
+            # pylint: disable=broad-except
+            except Exception:
+                block[2] = sys.exc_info()
+            # pylint: enable=broad-except
+            block[0].set()
+
+    def _submit(self):
+        block = [threading.Event(), None, None]
+        with self._lock:
+            self._queue.append((''.join(self._buf), block))
+            self._ready.notify()
+        self._pending.append(block)
+        self._buf = []
+        self._buf_len = 0
+        # Bound memory use by waiting for the oldest block once every
+        # worker is busy and another block is queued
+        while len(self._pending) > self._threads + 1:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        event, _, _ = block = self._pending.popleft()
+        event.wait()
+        if block[2] is not None:
+            raise block[2][0], block[2][1], block[2][2]
+        self._fout.write(block[1])
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buf_len += len(data)
+        if self._buf_len >= self._block_size:
+            self._submit()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            if self._buf_len:
+                self._submit()
+            while self._pending:
+                self._write_oldest()
+        finally:
+            with self._lock:
+                self._closing = True
+                self._queue.clear()
+                self._ready.notify_all()
+            for thread in self._workers:
+                thread.join()
+            self._fout.close()
+
+
 def copy_memory(in_path, out_path, xml=None, compression='xz', verbose=True,
-        low_priority=False):
+        low_priority=False, threads=None, progress=None):
+    '''in_path can also be a seekable readable file object, and out_path
+    a writable file object, which need not be seekable.  Both are closed
+    on return.  When compressing a raw image to a format that permits it,
+    blocks of the image are compressed on up to threads CPUs, defaulting
+    to all of them but no more than MEMORY_BLOCK_DEFAULT_THREADS.  If
+    progress is specified, it is called with the number of bytes copied
+    and the total instead of printing progress.'''
     def report(line, newline=True):
         if not verbose:
             return
@@ -57,8 +263,14 @@ def copy_memory(in_path, out_path, xml=None, compression='xz', verbose=True,
             sys.stdout.flush()
 
     # Open files, read header
-    fin = open(in_path, 'r')
-    fout = open(out_path, 'w')
+    if hasattr(out_path, 'write'):
+        fout = out_path
+    else:
+        fout = open(out_path, 'w')
+    if hasattr(in_path, 'read'):
+        fin = in_path
+    else:
+        fin = open(in_path, 'r')
     hdr = LibvirtQemuMemoryHeader(fin)
 
     # Determine input and output compression
@@ -66,13 +278,9 @@ def copy_memory(in_path, out_path, xml=None, compression='xz', verbose=True,
     if compress_in not in MEMORY_DECOMPRESS_COMMANDS:
         raise MachineGenerationError('Cannot decode save format %d' %
                 compress_in)
-    if compression == 'xz':
-        compress_out = hdr.COMPRESS_XZ
-    elif compression == 'lzop':
-        compress_out = hdr.COMPRESS_LZOP
-    elif compression == None:
-        compress_out = hdr.COMPRESS_RAW
-    else:
+    try:
+        compress_out = MEMORY_COMPRESSION_FORMATS[compression]
+    except KeyError:
         raise ValueError('Unknown compression: %s' % compression)
     if compress_out not in MEMORY_COMPRESS_COMMANDS:
         raise MachineGenerationError('Cannot encode save format %d' %
@@ -82,13 +290,25 @@ def copy_memory(in_path, out_path, xml=None, compression='xz', verbose=True,
     hdr.compressed = compress_out
     if xml is not None:
         hdr.xml = xml
-    hdr.write(fout, extend=True)
+    buf = StringIO()
+    hdr.write(buf, extend=True)
+    fout.write(buf.getvalue())
     fout.flush()
 
+    if threads is None:
+        threads = min(multiprocessing.cpu_count(),
+                MEMORY_BLOCK_DEFAULT_THREADS)
+
     processes = []
     try:
         # Start compressor/decompressor if required
-        if compress_in != compress_out:
+        block_command = MEMORY_BLOCK_COMPRESS_COMMANDS.get(compress_out)
+        if (compress_in == hdr.COMPRESS_RAW and threads > 1 and
+                block_command):
+            if low_priority:
+                block_command = ['nice'] + list(block_command)
+            fout = _BlockCompressor(block_command, fout, threads)
+        elif compress_in != compress_out:
             for command in (MEMORY_COMPRESS_COMMANDS[compress_out],
                     MEMORY_DECOMPRESS_COMMANDS[compress_in]):
                 if not command:
@@ -118,9 +338,13 @@ def copy_memory(in_path, out_path, xml=None, compression='xz', verbose=True,
             if not buf:
                 break
             fout.write(buf)
-            report('\r%s memory image: %3d%%' % (action,
-                    100 * fin.tell() / total), newline=False)
-        report('')
+            if progress is not None:
+                progress(fin.tell(), total)
+            else:
+                report('\r%s memory image: %3d%%' % (action,
+                        100 * fin.tell() / total), newline=False)
+        if progress is None:
+            report('')
     finally:
         # Clean up
         fin.close()
@@ -133,21 +357,207 @@ def copy_memory(in_path, out_path, xml=None, compression='xz', verbose=True,
             raise IOError('Compressor/decompressor failed')
 
 
-def copy_disk(in_path, type, out_path, raw=False):
+class _MemoryPipe(object):
+    '''Run copy_memory() in a background thread, making its output
+    available from the readable pipe fh.'''
+
+    def __init__(self, in_path, xml, compression, threads=None,
+            progress=None):
+        pipe_r, pipe_w = os.pipe()
+        self.fh = os.fdopen(pipe_r, 'r')
+        self._exc_info = None
+        self._thread = threading.Thread(name='vmnetx-copy-memory',
+                target=self._run,
+                args=(in_path, os.fdopen(pipe_w, 'w'), xml, compression,
+                threads, progress))
+        self._thread.start()
+
+    def _run(self, in_path, out, xml, compression, threads, progress):
+        try:
+            copy_memory(in_path, out, xml, compression=compression,
+                    threads=threads, progress=progress)
+        # Reraised in close()
+        # pylint: disable=broad-except
+        except Exception:
+            self._exc_info = sys.exc_info()
+        # pylint: enable=broad-except
+        finally:
+            # Ensure the reader sees EOF even if copy_memory() failed early
+            out.close()
+
+    def close(self):
+        '''Wait for the copy to finish and reraise any error.  Closing the
+        pipe first unblocks the copy if the reader has stopped early.'''
+        self.fh.close()
+        self._thread.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+
+def benchmark_memory(in_path, formats=('xz', 'lzop', 'zstd', 'lz4', None),
+        out_dir=None):
+    '''Convert the memory image at in_path to each of the specified
+    formats, and time the conversion and the decompression that restoring
+    the result would require.  Returns a list of (format, size, convert
+    seconds, restore seconds), with None for the measurements of formats
+    whose tools are not installed.'''
+    results = []
+    for compression in formats:
+        with NamedTemporaryFile(dir=out_dir or os.path.dirname(in_path),
+                prefix='benchmark-') as out:
+            try:
+                start = time.time()
+                copy_memory(in_path, out.name, compression=compression,
+                        verbose=False)
+                convert_time = time.time() - start
+            except OSError:
+                results.append((compression, None, None, None))
+                continue
+
+            with open(out.name, 'r') as fh:
+                hdr = LibvirtQemuMemoryHeader(fh)
+                command = MEMORY_DECOMPRESS_COMMANDS[hdr.compressed]
+                hdr.seek_body(fh)
+                start = time.time()
+                if command:
+                    with open(os.devnull, 'w') as null:
+                        ret = subprocess.call(command, stdin=fh, stdout=null,
+                                close_fds=True)
+                    if ret != 0:
+                        raise MachineGenerationError('%s failed' %
+                                command[0])
+                else:
+                    while fh.read(1 << 20):
+                        pass
+                restore_time = time.time() - start
+            results.append((compression, os.path.getsize(out.name),
+                    convert_time, restore_time))
+    return results
+
+
+def _open_package(path):
+    # path can be a local path or an http/https/file URL
+    if urlsplit(path).scheme in ('http', 'https', 'file'):
+        return Package(source_open(path))
+    else:
+        return Package(source_open(filename=path))
+
+
+def _write_package(out_file, name, domain_xml, disk_path, memory_path,
+        compression, chunk_index=False, compress_chunks=False, base=None,
+        page_index=False, threads=None, progress=None):
+    '''Write a package, streaming the memory image through copy_memory()
+    directly into it.  If progress is specified, nothing is printed.'''
+    if (MEMORY_COMPRESSION_FORMATS[compression] not in
+            LibvirtQemuMemoryHeader.LIBVIRT_FORMATS):
+        raise ValueError('libvirt cannot restore %s memory images' %
+                compression)
+    if progress is None:
+        print 'Writing package...'
+    memory = None
+    try:
+        if memory_path is not None:
+            memory = _MemoryPipe(memory_path, domain_xml, compression,
+                    threads=threads, progress=progress)
+        Package.create(out_file, name, domain_xml, disk_path,
+                memory.fh if memory else None, chunk_index=chunk_index,
+                compress_chunks=compress_chunks, base=base,
+                page_index=page_index)
+        if memory is not None:
+            memory.close()
+    except:
+        exc_info = sys.exc_info()
+        if memory is not None:
+            try:
+                memory.close()
+            # The original exception is more interesting
+            # pylint: disable=broad-except
+            except Exception:
+                pass
+            # pylint: enable=broad-except
+        if os.path.exists(out_file):
+            os.unlink(out_file)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def _image_opts(path, type, offset, length):
+    # Describe an image stored at a byte range of a file, so that qemu-img
+    # can read it in place.  Commas in option values are doubled.
+    path = path.replace(',', ',,')
+    if type == 'raw':
+        return ('driver=raw,offset=%d,size=%d,file.driver=file,'
+                'file.filename=%s' % (offset, length, path))
+    return ('driver=%s,file.driver=raw,file.offset=%d,file.size=%d,'
+            'file.file.driver=file,file.file.filename=%s' % (type, offset,
+            length, path))
+
+
+def copy_disk(in_path, type, out_path, raw=False, offset=None, length=None,
+        progress=None):
+    '''If offset and length are specified, the image is read from that
+    byte range of in_path.  If progress is specified, it is called with
+    the percentage complete and 100 instead of printing anything.'''
+    if offset is not None:
+        source = ['--image-opts', _image_opts(in_path, type, offset, length)]
+    else:
+        source = ['-f', type, in_path]
     if raw:
-        print 'Copying disk image...'
-        ret = subprocess.call(['qemu-img', 'convert', '-p', '-f', type,
-                '-O', 'raw', in_path, out_path])
+        if progress is None:
+            print 'Copying disk image...'
+        command = ['qemu-img', 'convert', '-p'] + source + ['-O', 'raw',
+                out_path]
     else:
-        print 'Copying and compressing disk image...'
-        ret = subprocess.call(['qemu-img', 'convert', '-cp', '-f', type,
-                '-O', 'qcow2', in_path, out_path])
+        if progress is None:
+            print 'Copying and compressing disk image...'
+        command = ['qemu-img', 'convert', '-cp'] + source + ['-O', 'qcow2',
+                out_path]
+
+    if progress is None:
+        ret = subprocess.call(command)
+    else:
+        # qemu-img reports "    (12.34/100%)\r"
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                close_fds=True)
+        line = ''
+        while True:
+            buf = proc.stdout.read(1)
+            if not buf:
+                break
+            if buf not in '\r\n':
+                line += buf
+                continue
+            match = re.search(r'\(([0-9.]+)/100%\)', line)
+            if match:
+                progress(float(match.group(1)), 100)
+            line = ''
+        ret = proc.wait()
 
     if ret != 0:
         raise MachineGenerationError('qemu-img failed')
 
 
-def generate_machine(name, in_xml, out_file, compress=True):
+def generate_machine(name, in_xml, out_file, compress=True,
+        chunk_index=False, compress_chunks=False, base=None, cpus=None,
+        page_index=False):
+    '''The disk and memory images are converted concurrently, using up
+    to cpus CPUs, defaulting to all of them.  By default, the memory image
+    is compressed on no more than MEMORY_BLOCK_DEFAULT_THREADS CPUs.'''
+    # Chunk compression replaces whole-image compression, deltas require
+    # raw images whose unchanged chunks hash identically, and the page
+    # index can only be built from an uncompressed memory image
+    if compress_chunks or base is not None or page_index:
+        compress = False
+
+    # Open base package
+    if base is not None:
+        try:
+            base = _open_package(base)
+        except (BadPackageError, SourceError, ValueError), e:
+            raise MachineGenerationError('Could not open base package: %s' %
+                    e, getattr(e, 'detail', None))
+        if base.disk.chunks is None:
+            raise MachineGenerationError('Base package has no chunk index')
+
     # Parse domain XML
     try:
         with open(in_xml) as fh:
@@ -166,42 +576,92 @@ def generate_machine(name, in_xml, out_file, compress=True):
     domain_xml = domain.get_for_storage(disk_type='qcow2' if compress
             else 'raw').xml
 
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+        memory_cpus = min(cpus, MEMORY_BLOCK_DEFAULT_THREADS)
+    else:
+        memory_cpus = cpus
+
+    # Check memory
+    if not os.path.exists(in_memory):
+        print 'No memory image found'
+        in_memory = None
+
     temp_disk = None
-    temp_memory = None
+    disk_job = None
+    disk_path = None
+    progress = None
     try:
-        # Copy disk
-        out_dir = os.path.dirname(out_file)
-        temp_disk = NamedTemporaryFile(dir=out_dir, prefix='disk-')
-        copy_disk(domain.disk_path, domain.disk_type, temp_disk.name,
-                raw=not compress)
-
-        # Copy memory
-        if os.path.exists(in_memory):
-            temp_memory = NamedTemporaryFile(dir=out_dir, prefix='memory-')
-            copy_memory(in_memory, temp_memory.name, domain_xml,
-                    compression='xz' if compress else None)
+        # Copy disk in the background while the memory image, which comes
+        # first in the package, is converted.  A raw disk going into an
+        # uncompressed package is already in its final form, so it is
+        # packaged directly.
+        memory_threads = memory_cpus
+        if compress or domain.disk_type != 'raw':
+            out_dir = os.path.dirname(out_file)
+            temp_disk = NamedTemporaryFile(dir=out_dir, prefix='disk-')
+            if in_memory is not None:
+                # Nothing else may print while the progress line is shown
+                print 'Copying disk image and writing package...'
+                progress = _Progress(('Disk', 'Memory'))
+                # Leave a CPU for qemu-img
+                memory_threads = max(min(memory_cpus, cpus - 1), 1)
+            disk_job = _Job('vmnetx-copy-disk', copy_disk, domain.disk_path,
+                    domain.disk_type, temp_disk.name, raw=not compress,
+                    progress=progress.callback('Disk') if progress else None)
+            disk_path = _PendingFile(disk_job, temp_disk.name)
         else:
-            print 'No memory image found'
+            disk_path = domain.disk_path
 
-        # Write package
-        print 'Writing package...'
-        try:
-            Package.create(out_file, name, domain_xml, temp_disk.name,
-                    temp_memory.name if temp_memory else None)
-        except:
-            os.unlink(out_file)
-            raise
+        # Write package, converting memory on the fly
+        _write_package(out_file, name, domain_xml, disk_path, in_memory,
+                'xz' if compress else None, chunk_index=chunk_index,
+                compress_chunks=compress_chunks, base=base,
+                page_index=page_index, threads=memory_threads,
+                progress=progress.callback('Memory') if progress else None)
     finally:
+        if progress:
+            progress.finish()
+        if disk_job:
+            # qemu-img must be done with the file before it is deleted.
+            # Any error has already been raised by _PendingFile.
+            # pylint: disable=broad-except
+            try:
+                disk_job.wait()
+            except Exception:
+                pass
+            # pylint: enable=broad-except
+            disk_path.close()
         if temp_disk:
             temp_disk.close()
-        if temp_memory:
-            temp_memory.close()
 
 
-def compress_machine(in_file, out_file, name=None):
-    '''Read an uncompressed machine package and write a compressed one.'''
+def _extract_member(member, out_fh, what, segments):
+    def progress(count, total):
+        print '\rExtracting %s: %3d%%' % (what, 100 * count / total),
+        sys.stdout.flush()
+    member.write_to_file(out_fh, segments=segments, progress=progress,
+            sparse=True)
+    print
+
 
-    package = Package(source_open(filename=in_file))
+def compress_machine(in_file, out_file, name=None, segments=4):
+    '''Read an uncompressed machine package and write a compressed one.
+    in_file can be a local path or an http/https/file URL.  The memory
+    image is streamed from the package into the compressor, and a local
+    disk image is converted in place.  Otherwise the disk image is
+    extracted over up to segments concurrent connections.  The base
+    package of a delta package is loaded, and the output contains the
+    complete images.'''
+
+    package = _open_package(in_file)
+
+    # Delta images read unchanged chunks from the base package
+    try:
+        package.load_base()
+    except (BadPackageError, SourceError, ValueError), e:
+        raise MachineGenerationError('Could not open base package: %s' %
+                e, getattr(e, 'detail', None))
 
     # Parse domain XML
     try:
@@ -214,39 +674,39 @@ def compress_machine(in_file, out_file, name=None):
     domain_xml = domain.get_for_storage(keep_uuid=True).xml
 
     temp_disk = None
-    temp_memory = None
+    memory = None
     try:
-        # Copy disk
+        # Copy disk, reading it in place if possible
         out_dir = os.path.dirname(out_file)
         temp_disk = NamedTemporaryFile(dir=out_dir, prefix='disk-')
-        with NamedTemporaryFile(dir=out_dir, prefix='in-') as temp_in:
-            print 'Extracting disk image...'
-            package.disk.write_to_file(temp_in)
-            temp_in.flush()
-            copy_disk(temp_in.name, domain.disk_type, temp_disk.name)
-
-        # Copy memory
-        if package.memory:
-            temp_memory = NamedTemporaryFile(dir=out_dir, prefix='memory-')
+        converted = False
+        if package.disk.local_path is not None:
+            try:
+                copy_disk(package.disk.local_path, domain.disk_type,
+                        temp_disk.name, offset=package.disk.offset,
+                        length=package.disk.length)
+                converted = True
+            except MachineGenerationError:
+                # Perhaps qemu-img is too old to read at an offset
+                print 'Could not read disk image in place; extracting it'
+        if not converted:
             with NamedTemporaryFile(dir=out_dir, prefix='in-') as temp_in:
-                print 'Extracting memory image...'
-                package.memory.write_to_file(temp_in)
+                _extract_member(package.disk, temp_in, 'disk image',
+                        segments)
                 temp_in.flush()
-                copy_memory(temp_in.name, temp_memory.name, domain_xml,
-                        compression='xz')
+                copy_disk(temp_in.name, domain.disk_type, temp_disk.name)
+
+        # Stream memory from the package
+        if package.memory:
+            memory = package.memory.open()
         else:
             print 'No memory image found'
 
-        # Write package
-        print 'Writing package...'
-        try:
-            Package.create(out_file, name or package.name, domain_xml,
-                    temp_disk.name, temp_memory.name if temp_memory else None)
-        except:
-            os.unlink(out_file)
-            raise
+        # Write package, compressing memory on the fly
+        _write_package(out_file, name or package.name, domain_xml,
+                temp_disk.name, memory, 'xz')
     finally:
         if temp_disk:
             temp_disk.close()
-        if temp_memory:
-            temp_memory.close()
+        if memory:
+            memory.close()
@@ -16,6 +16,7 @@
 #
 
 from __future__ import division
+from array import array
 import struct
 
 class MemoryImageError(Exception):
@@ -34,9 +35,19 @@ class LibvirtQemuMemoryHeader(object):
     XML_MINIMUM_PAD = 8 << 10
     XML_END_ALIGNMENT = 4 << 10   # QEMU_MONITOR_MIGRATE_TO_FILE_BS
 
+    # Formats defined by libvirt
     COMPRESS_RAW = 0
     COMPRESS_XZ = 3
     COMPRESS_LZOP = 4
+    # raw, gzip, bzip2, xz, lzop
+    LIBVIRT_FORMATS = frozenset(range(5))
+    # Formats private to VMNetX, which libvirt cannot restore.  Images in
+    # these formats are only for VMNetX's own use, and must never be
+    # written into a package or handed to libvirt.  They are numbered well
+    # above libvirt's formats so that they cannot collide with formats
+    # libvirt adds later.
+    COMPRESS_ZSTD = 0x10001
+    COMPRESS_LZ4 = 0x10002
 
     def __init__(self, fh):
         # Read header struct
@@ -62,6 +73,11 @@ class LibvirtQemuMemoryHeader(object):
         if fh.read(1) != '\0':
             raise MemoryImageError('Missing NUL byte after XML')
 
+    @property
+    def libvirt_compatible(self):
+        '''True if libvirt can restore an image in this format.'''
+        return self.compressed in self.LIBVIRT_FORMATS
+
     def seek_body(self, fh):
         fh.seek(self.HEADER_LENGTH + self._xml_len)
 
@@ -179,3 +195,272 @@ class LibvirtQemuMemoryHeaderData(LibvirtQemuMemoryHeader):
         header_binary = struct.pack(self.HEADER_FORMAT, *header)
         header_binary += struct.pack('%ds' % self._xml_len, self.xml)
         return header_binary
+
+
+class QemuMemoryIndex(object):
+    '''Index of the guest RAM pages in an uncompressed libvirt QEMU memory
+    image, recording the offset of the most recent copy of each page
+    within the image and whether the page is zero.  Pages are numbered
+    consecutively across the RAM blocks, in order.'''
+
+    MAGIC = 'VMNXPIDX'
+    VERSION = 1
+    HEADER_FORMAT = '<8sIII'
+
+    def __init__(self, page_size, blocks, offsets, zero, fill=None):
+        self.page_size = page_size
+        # [(name, length)]
+        self.blocks = blocks
+        # Image offset of each page, or 0 if the image has no data for it
+        self.offsets = offsets
+        # Bitmap of zero pages
+        self.zero = zero
+        # Pages filled with a nonzero byte: {page: byte}
+        self.fill = fill or {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def page_offset(self, page):
+        offset = self.offsets[page]
+        return offset if offset else None
+
+    def is_zero(self, page):
+        return bool(self.zero[page >> 3] & (1 << (page & 7)))
+
+    @classmethod
+    def build(cls, fh, buf_size=1 << 20):
+        '''Index the memory image read from file object fh.'''
+        parser = QemuMemoryParser()
+        while True:
+            buf = fh.read(buf_size)
+            if not buf:
+                break
+            parser.feed(buf)
+        return parser.finish()
+
+    @classmethod
+    def read(cls, fh):
+        def read_exactly(count):
+            data = fh.read(count)
+            if len(data) != count:
+                raise MemoryImageError('Page index is truncated')
+            return data
+
+        magic, version, page_size, block_count = struct.unpack(
+                cls.HEADER_FORMAT,
+                read_exactly(struct.calcsize(cls.HEADER_FORMAT)))
+        if magic != cls.MAGIC:
+            raise MemoryImageError('Invalid page index magic')
+        if version != cls.VERSION:
+            raise MemoryImageError('Unknown page index version %d' % version)
+        blocks = []
+        for _ in range(block_count):
+            name = read_exactly(ord(read_exactly(1)))
+            length, = struct.unpack('<Q', read_exactly(8))
+            blocks.append((name, length))
+        pages = sum(length // page_size for _, length in blocks)
+        offsets = _offset_array(struct.unpack('<%dQ' % pages,
+                read_exactly(8 * pages)))
+        zero = bytearray(read_exactly((pages + 7) // 8))
+        fill_count, = struct.unpack('<I', read_exactly(4))
+        fill = {}
+        for _ in range(fill_count):
+            page, value = struct.unpack('<QB', read_exactly(9))
+            fill[page] = value
+        return cls(page_size, blocks, offsets, zero, fill)
+
+    def write(self, fh):
+        fh.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION,
+                self.page_size, len(self.blocks)))
+        for name, length in self.blocks:
+            fh.write(chr(len(name)) + name + struct.pack('<Q', length))
+        fh.write(struct.pack('<%dQ' % len(self.offsets), *self.offsets))
+        fh.write(str(self.zero))
+        fh.write(struct.pack('<I', len(self.fill)))
+        for page in sorted(self.fill):
+            fh.write(struct.pack('<QB', page, self.fill[page]))
+
+
+def _offset_array(values):
+    # Python 2 arrays have no 'Q' typecode, and 'L' is only 64 bits on
+    # LP64 platforms
+    if array('L').itemsize >= 8:
+        return array('L', values)
+    return list(values)
+
+
+class QemuMemoryParser(object):
+    '''Incrementally parse the RAM section of the QEMU migration stream in
+    an uncompressed libvirt QEMU memory image, fed in order to feed(), and
+    build a QemuMemoryIndex.'''
+
+    QEMU_MAGIC = 0x5145564d
+    QEMU_VERSION = 3
+    SECTION_START = 0x01
+    SECTION_PART = 0x02
+    SECTION_END = 0x03
+    SECTION_FOOTER = 0x7e
+
+    FLAG_ZERO = 0x02
+    FLAG_MEM_SIZE = 0x04
+    FLAG_PAGE = 0x08
+    FLAG_EOS = 0x10
+    FLAG_CONTINUE = 0x20
+
+    PAGE_SIZE = 4096
+    # How far to look for the start of the RAM section
+    MAX_PREAMBLE = 64 << 10
+
+    def __init__(self):
+        self._buf = ''
+        self._pos = 0
+        # Image offset of the start of self._buf
+        self._offset = 0
+        self._needed = 0
+        self._index = None
+        self._done = False
+        self._parser = self._parse()
+        self._needed = self._parser.next()
+
+    def feed(self, data):
+        if self._done:
+            return
+        self._buf = self._buf[self._pos:] + data
+        self._offset += self._pos
+        self._pos = 0
+        while len(self._buf) - self._pos >= self._needed:
+            start = self._pos
+            self._pos += self._needed
+            try:
+                self._needed = self._parser.send((self._offset + start,
+                        self._buf[start:self._pos]))
+            except StopIteration:
+                self._done = True
+                self._buf = ''
+                self._pos = 0
+                return
+
+    def finish(self):
+        if not self._done:
+            raise MemoryImageError('Memory image RAM section is truncated')
+        return self._index
+
+    def _parse(self):
+        # Generator receiving (offset, data) for each requested number of
+        # bytes
+
+        # libvirt header
+        _, data = yield LibvirtQemuMemoryHeader.HEADER_LENGTH
+        header = struct.unpack(LibvirtQemuMemoryHeader.HEADER_FORMAT, data)
+        if header[0] != LibvirtQemuMemoryHeader.HEADER_MAGIC:
+            raise MemoryImageError('Invalid memory image magic')
+        if header[4] != LibvirtQemuMemoryHeader.COMPRESS_RAW:
+            raise MemoryImageError('Memory image is compressed')
+        yield header[2]
+
+        # QEMU header
+        _, data = yield 8
+        magic, version = struct.unpack('>II', data)
+        if magic != self.QEMU_MAGIC or version != self.QEMU_VERSION:
+            raise MemoryImageError('Unknown QEMU migration stream format')
+
+        # Skip to the RAM section start, which follows the configuration
+        # section.  Its header is SECTION_START, section ID, "\3ram".
+        window = ''
+        for _ in xrange(self.MAX_PREAMBLE):
+            _, data = yield 1
+            window = (window + data)[-9:]
+            if (len(window) == 9 and ord(window[0]) == self.SECTION_START
+                    and window[5:] == '\3ram'):
+                break
+        else:
+            raise MemoryImageError('No RAM section in memory image')
+        ram_section, = struct.unpack('>I', window[1:5])
+        # Instance and version IDs
+        yield 8
+
+        # RAM block list
+        _, data = yield 8
+        value, = struct.unpack('>Q', data)
+        if not value & self.FLAG_MEM_SIZE:
+            raise MemoryImageError('RAM section has no block list')
+        total = value & ~(self.PAGE_SIZE - 1)
+        blocks = []
+        block_start = {}
+        pages = 0
+        while sum(length for _, length in blocks) < total:
+            _, data = yield 1
+            _, name = yield ord(data)
+            _, data = yield 8
+            length, = struct.unpack('>Q', data)
+            blocks.append((name, length))
+            block_start[name] = pages
+            pages += length // self.PAGE_SIZE
+        offsets = _offset_array([0]) * pages
+        zero = bytearray((pages + 7) // 8)
+        fill = {}
+        zero_page = '\0' * self.PAGE_SIZE
+
+        # Pages, in SECTION_PART and SECTION_END sections
+        block = None
+        section_type = self.SECTION_START
+        while True:
+            # Read pages to end of section
+            while True:
+                _, data = yield 8
+                value, = struct.unpack('>Q', data)
+                flags = value & (self.PAGE_SIZE - 1)
+                address = value & ~(self.PAGE_SIZE - 1)
+                if flags & self.FLAG_EOS:
+                    break
+                if flags & self.FLAG_MEM_SIZE:
+                    raise MemoryImageError('Unexpected RAM block list')
+                if not flags & (self.FLAG_ZERO | self.FLAG_PAGE):
+                    raise MemoryImageError('Unsupported RAM page flags %#x'
+                            % flags)
+                if not flags & self.FLAG_CONTINUE:
+                    _, data = yield 1
+                    _, block = yield ord(data)
+                    if block not in block_start:
+                        raise MemoryImageError('Unknown RAM block %s' %
+                                block)
+                elif block is None:
+                    raise MemoryImageError('RAM page has no block')
+                page = block_start[block] + address // self.PAGE_SIZE
+                if page >= pages:
+                    raise MemoryImageError('RAM page out of range')
+                if flags & self.FLAG_ZERO:
+                    _, data = yield 1
+                    offsets[page] = 0
+                    zero[page >> 3] |= 1 << (page & 7)
+                    if data != '\0':
+                        fill[page] = ord(data)
+                    else:
+                        fill.pop(page, None)
+                else:
+                    offset, data = yield self.PAGE_SIZE
+                    offsets[page] = offset
+                    fill.pop(page, None)
+                    if data == zero_page:
+                        zero[page >> 3] |= 1 << (page & 7)
+                    else:
+                        zero[page >> 3] &= ~(1 << (page & 7))
+            if section_type == self.SECTION_END:
+                break
+
+            # Next section
+            _, data = yield 1
+            if ord(data) == self.SECTION_FOOTER:
+                yield 4
+                _, data = yield 1
+            section_type = ord(data)
+            if section_type not in (self.SECTION_PART, self.SECTION_END):
+                raise MemoryImageError('Unexpected section type %d' %
+                        section_type)
+            _, data = yield 4
+            if struct.unpack('>I', data)[0] != ram_section:
+                raise MemoryImageError('Unsupported iterative section')
+
+        self._index = QemuMemoryIndex(self.PAGE_SIZE, blocks, offsets, zero,
+                fill)
@@ -15,18 +15,28 @@
 # for more details.
 #
 
+import base64
+from collections import OrderedDict, namedtuple
 from datetime import datetime
+from hashlib import sha256
+import json
 from lxml import etree
 from lxml.builder import ElementMaker
 import os
 import requests
+from StringIO import StringIO
 import struct
-from urlparse import urlsplit, urljoin
+import threading
+import time
+from urlparse import urlsplit, urlunsplit, urljoin
 import zipfile
+import zlib
 
-from .source import SourceError, SourceRange
+from .memory import MemoryImageError, QemuMemoryIndex, QemuMemoryParser
+from .source import SourceError, SourceRange, source_open
 from .system import schemadir
-from .util import DetailException
+from .util import (DetailException, ensure_dir, get_pristine_cache_dir,
+        get_requests_session, rename)
 
 NS = 'http://olivearchive.org/xmlns/vmnetx/package'
 NSP = '{' + NS + '}'
@@ -36,6 +46,20 @@ MANIFEST_FILENAME = 'vmnetx-package.xml'
 DOMAIN_FILENAME = 'domain.xml'
 DISK_FILENAME = 'disk.img'
 MEMORY_FILENAME = 'memory.img'
+MEMORY_PAGE_INDEX_FILENAME = 'memory.idx'
+PADDING_PREFIX = '.padding/'
+
+# Disk and memory data are aligned to the default vmnetfs chunk size, so
+# each chunk fetch maps to one aligned range on the origin server
+DEFAULT_ALIGNMENT = 128 << 10
+# Private local-header extra field recording the alignment of the member
+# data.  It carries the alignment as a 32-bit integer, followed by any
+# zero padding needed to achieve it.
+ALIGNMENT_EXTRA_ID = 0x4e56
+ALIGNMENT_EXTRA_FMT = '<HHI'
+
+# Chunk size of the optional per-chunk index
+INDEX_CHUNK_SIZE = 128 << 10
 
 
 # We want this to be a public attribute
@@ -70,12 +94,508 @@ class _PackageMember(SourceRange):
             raise BadPackageError('Member "%s" is compressed' % path)
         if flags & 0x1:
             raise BadPackageError('Member "%s" is encrypted' % path)
-        SourceRange.__init__(self, source,
-                info.header_offset + header_len + name_len + extra_len,
-                info.file_size, load_data)
+        offset = info.header_offset + header_len + name_len + extra_len
+
+        # Look for an alignment record in the extra field, and verify it
+        self.alignment = None
+        pos = info.header_offset + header_len + name_len
+        while pos + 4 <= offset:
+            source.seek(pos)
+            id, size = struct.unpack('<HH', source.read(4))
+            if id == ALIGNMENT_EXTRA_ID and size >= 4:
+                self.alignment = struct.unpack('<I', source.read(4))[0]
+                break
+            pos += 4 + size
+        if self.alignment and offset % self.alignment:
+            raise BadPackageError('Member "%s" is not aligned to %d bytes' %
+                    (path, self.alignment))
+
+        SourceRange.__init__(self, source, offset, info.file_size, load_data)
+
+
+# hash is None for zero chunks.  offset and length locate an independently
+# compressed copy of the chunk in the index's data member, if any.  base is
+# the index of an identical chunk in the base package.
+ChunkInfo = namedtuple('ChunkInfo',
+        'hash zero duplicate_of offset length compression base')
+# Metadata cache entries from before delta packages lack base
+ChunkInfo.__new__.__defaults__ = (None,)
+
+
+class ChunkIndex(object):
+    '''Per-chunk index of a disk or memory image (package format version
+    2), recording the hash of each chunk, whether it is all zeroes or a
+    duplicate of an earlier chunk, and where to find a compressed copy.'''
+
+    COMPRESS_NONE = 'none'
+    COMPRESS_ZLIB = 'zlib'
+
+    def __init__(self, chunk_size, chunks, data=None):
+        self.chunk_size = chunk_size
+        self.chunks = chunks
+        # SourceRange holding compressed chunks
+        self.data = data
+        # SourceRange holding the image; set by the owner
+        self.member = None
+        # ChunkIndex of the corresponding image in the base package; set
+        # by Package.load_base()
+        self.base = None
+        # Serializes use of the data and member sources, which may be
+        # shared with delta packages reading from multiple threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    @classmethod
+    def from_element(cls, el, data=None):
+        chunks = []
+        for c in el.iterchildren(NSP + 'chunk'):
+            duplicate_of = c.get('duplicate-of')
+            offset = c.get('offset')
+            length = c.get('length')
+            base = c.get('base')
+            chunks.append(ChunkInfo(c.get('hash'),
+                    c.get('zero') in ('true', '1'),
+                    int(duplicate_of) if duplicate_of is not None else None,
+                    int(offset) if offset is not None else None,
+                    int(length) if length is not None else None,
+                    c.get('compression'),
+                    int(base) if base is not None else None))
+            if chunks[-1].hash is None and not chunks[-1].zero:
+                raise BadPackageError('Chunk %d has no hash' %
+                        (len(chunks) - 1))
+        return cls(int(el.get('size')), chunks, data)
+
+    def to_element(self, e, path=None):
+        el = e.chunks(size=str(self.chunk_size))
+        if path is not None:
+            el.set('path', path)
+        for chunk in self.chunks:
+            c = e.chunk()
+            if chunk.hash is not None:
+                c.set('hash', chunk.hash)
+            if chunk.zero:
+                c.set('zero', 'true')
+            if chunk.duplicate_of is not None:
+                c.set('duplicate-of', str(chunk.duplicate_of))
+            if chunk.base is not None:
+                c.set('base', str(chunk.base))
+            if chunk.offset is not None:
+                c.set('offset', str(chunk.offset))
+                c.set('length', str(chunk.length))
+                c.set('compression', chunk.compression)
+            el.append(c)
+        return el
+
+    def read(self, chunk):
+        '''Return the contents of the specified chunk, fetching the
+        compressed copy if there is one.'''
+        length = min(self.chunk_size,
+                self.member.length - chunk * self.chunk_size)
+        info = self.chunks[chunk]
+        if info.zero:
+            return '\0' * length
+        if info.duplicate_of is not None:
+            return self.read(info.duplicate_of)
+        if info.base is not None:
+            if self.base is None:
+                raise BadPackageError('Chunk %d is stored in the base '
+                        'package, which is not loaded' % chunk)
+            data = self.base.read(info.base)
+        elif info.offset is not None and self.data is not None:
+            with self._lock:
+                self.data.source.seek(self.data.offset + info.offset)
+                data = self.data.source.read(info.length)
+            if info.compression == self.COMPRESS_ZLIB:
+                try:
+                    data = zlib.decompress(data)
+                except zlib.error, e:
+                    raise BadPackageError('Chunk %d: %s' % (chunk, e))
+            elif info.compression != self.COMPRESS_NONE:
+                raise BadPackageError('Unknown chunk compression %s' %
+                        info.compression)
+        else:
+            with self._lock:
+                self.member.source.seek(self.member.offset +
+                        chunk * self.chunk_size)
+                data = self.member.source.read(length)
+        if len(data) != length or sha256(data).hexdigest() != info.hash:
+            raise BadPackageError('Chunk %d failed verification' % chunk)
+        return data
+
+
+class _ChunkIndexer(object):
+    '''Build a ChunkIndex from image data fed to update() in order.
+    update() and flush() return the data to be stored: the input itself,
+    or if compress is True, a frame for each chunk that is neither zero
+    nor a duplicate, compressed independently of the others.  If base is
+    a ChunkIndex, chunks found in it are recorded as references to it
+    rather than stored, and the remaining chunks are stored as frames
+    even if compress is False.'''
+
+    def __init__(self, chunk_size=INDEX_CHUNK_SIZE, compress=False,
+            base=None):
+        if base is not None:
+            chunk_size = base.chunk_size
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.chunked = compress or base is not None
+        self.size = 0
+        self._zero = '\0' * chunk_size
+        self._pending = ''
+        self._first = {}
+        self._base = {}
+        if base is not None:
+            for chunk, info in enumerate(base.chunks):
+                if info.hash is not None:
+                    self._base.setdefault(info.hash, chunk)
+        self._chunks = []
+        self._stored = 0
+
+    def update(self, data):
+        self.size += len(data)
+        if self._pending:
+            data = self._pending + data
+        end = len(data) - len(data) % self.chunk_size
+        frames = [self._add(data[offset:offset + self.chunk_size])
+                for offset in xrange(0, end, self.chunk_size)]
+        self._pending = data[end:]
+        return ''.join(frames) if self.chunked else data[:end]
+
+    def flush(self):
+        data = self._pending
+        self._pending = ''
+        if data:
+            frame = self._add(data)
+            return frame if self.chunked else data
+        return ''
+
+    def finish(self):
+        return ChunkIndex(self.chunk_size, self._chunks)
+
+    def _add(self, data):
+        if data == self._zero[:len(data)]:
+            self._chunks.append(ChunkInfo(None, True, None, None, None,
+                    None))
+            return ''
+        hash = sha256(data).hexdigest()
+        duplicate_of = self._first.get(hash)
+        base = self._base.get(hash)
+        if not self.chunked or duplicate_of is not None or base is not None:
+            self._chunks.append(ChunkInfo(hash, False, duplicate_of, None,
+                    None, None, base if duplicate_of is None else None))
+            self._first.setdefault(hash, len(self._chunks) - 1)
+            return ''
+        if self.compress:
+            frame = zlib.compress(data)
+            compression = ChunkIndex.COMPRESS_ZLIB
+        if not self.compress or len(frame) >= len(data):
+            frame = data
+            compression = ChunkIndex.COMPRESS_NONE
+        self._chunks.append(ChunkInfo(hash, False, None, self._stored,
+                len(frame), compression))
+        self._first[hash] = len(self._chunks) - 1
+        self._stored += len(frame)
+        return frame
+
+
+class _ChunkedSource(object):
+    '''A read-only file-like view of an image stored as independently
+    compressed chunks, decompressing only the chunks that are read.'''
+
+    def __init__(self, index, length):
+        self._index = index
+        self.length = length
+        source = index.data.source
+        self.url = source.url
+        self.cookies = source.cookies
+        self.etag = source.etag
+        self.last_modified = source.last_modified
+        self._offset = 0
+        self._closed = False
+        # Most recently decompressed chunk
+        self._chunk = None
+        self._chunk_data = None
+
+    @property
+    def name(self):
+        return '<%s compressed image>' % self.url
+
+    def dup(self):
+        index = ChunkIndex(self._index.chunk_size, self._index.chunks,
+                SourceRange(self._index.data.source.dup(),
+                self._index.data.offset, self._index.data.length))
+        index.base = self._index.base
+        other = _ChunkedSource(index, self.length)
+        index.member = SourceRange(other, 0, self.length)
+        return other
+
+    def _read_chunk(self, chunk):
+        if chunk != self._chunk:
+            self._chunk_data = self._index.read(chunk)
+            self._chunk = chunk
+        return self._chunk_data
+
+    def read(self, size=None):
+        if self._closed:
+            raise IOError('File is closed')
+        if size is None or size < 0:
+            size = self.length - self._offset
+        size = max(min(size, self.length - self._offset), 0)
+        ret = []
+        while size > 0:
+            chunk, start = divmod(self._offset, self._index.chunk_size)
+            data = self._read_chunk(chunk)[start:start + size]
+            ret.append(data)
+            self._offset += len(data)
+            size -= len(data)
+        return ''.join(ret)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        memoryview(b)[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            pass
+        elif whence == 1:
+            offset += self._offset
+        elif whence == 2:
+            offset += self.length
+        else:
+            raise IOError('Invalid whence')
+        if offset < 0:
+            raise IOError('Invalid offset')
+        self._offset = offset
+
+    def tell(self):
+        return self._offset
+
+    def close(self):
+        self._closed = True
+        self._chunk_data = None
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+class _ParsingReader(object):
+    '''File object wrapper feeding everything read from fh to parser.'''
+
+    def __init__(self, fh, parser):
+        self._fh = fh
+        self._parser = parser
+
+    def read(self, size=-1):
+        buf = self._fh.read(size)
+        self._parser.feed(buf)
+        return buf
+
+
+def _chunked_member(index, length, alignment):
+    # The range covers the decoded image, which does not exist at the
+    # origin, so chunks cannot be fetched from member.source.url
+    member = SourceRange(_ChunkedSource(index, length), 0, length)
+    member.alignment = alignment
+    member.chunked = True
+    member.chunks = index
+    index.member = member
+    return member
+
+
+def _member_desc(member):
+    chunks = getattr(member, 'chunks', None)
+    if chunks is not None:
+        chunks = {
+            'size': chunks.chunk_size,
+            'chunks': chunks.chunks,
+            'data': _member_desc(chunks.data) if chunks.data else None,
+            'chunked': isinstance(member.source, _ChunkedSource),
+        }
+    page_index = getattr(member, 'page_index', None)
+    return [member.offset, member.length, member.alignment, chunks,
+            _member_desc(page_index) if page_index else None]
+
+
+def _cached_member(source, desc):
+    # Entries written before page indexes have no page index descriptor
+    offset, length, alignment, chunks = desc[:4]
+    page_index = desc[4] if len(desc) > 4 else None
+    if chunks is not None:
+        index = ChunkIndex(chunks['size'],
+                [ChunkInfo(*c) for c in chunks['chunks']],
+                _cached_member(source, chunks['data'])
+                if chunks['data'] else None)
+    if chunks is not None and chunks['chunked']:
+        member = _chunked_member(index, length, alignment)
+    else:
+        member = SourceRange(source, offset, length)
+        member.alignment = alignment
+        member.chunks = None
+        if chunks is not None:
+            member.chunks = index
+            index.member = member
+    member.page_index = (_cached_member(source, page_index)
+            if page_index else None)
+    return member
+
+
+class _PackageZipFile(zipfile.ZipFile):
+    def _local_header(self, zinfo, extra):
+        # The extra field belongs only in the local header; ZipFile.close()
+        # writes zinfo.extra into the central directory too
+        zinfo.extra = extra
+        header = zinfo.FileHeader(True)
+        zinfo.extra = ''
+        return header
+
+    def _align(self, zinfo, alignment):
+        '''Return the local-header extra field needed to align the data of
+        zinfo, first writing a padding member if the required padding
+        would not fit in an extra field.'''
+        record_len = struct.calcsize(ALIGNMENT_EXTRA_FMT)
+        header_len = len(self._local_header(zinfo, '\0' * record_len))
+        pad = -(self.fp.tell() + header_len) % alignment
+        # Leave room for the ZIP64 extra field added by FileHeader()
+        if record_len + pad > 0xffff - 20:
+            pad_info = zipfile.ZipInfo(PADDING_PREFIX + zinfo.filename,
+                    zinfo.date_time)
+            pad_header_len = zipfile.sizeFileHeader + len(pad_info.filename)
+            self.writestr(pad_info, '\0' * (-(self.fp.tell() +
+                    pad_header_len + header_len) % alignment))
+            zinfo.header_offset = self.fp.tell()
+            pad = 0
+        return struct.pack(ALIGNMENT_EXTRA_FMT, ALIGNMENT_EXTRA_ID,
+                record_len - 4 + pad, alignment) + '\0' * pad
+
+    def write_stream(self, fh, arcname, buf_size=1 << 20, alignment=None,
+            indexer=None):
+        '''Append a stored member read from fh until EOF.  The size need
+        not be known in advance: the member is always written with a ZIP64
+        local header, whose sizes and CRC are back-patched afterward, so
+        the archive must be seekable but fh need not be.  If alignment is
+        specified, the member data is padded to start at a multiple of
+        it.  If indexer is specified, the data is passed through it, and
+        what it returns is stored.'''
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[0:6])
+        zinfo.external_attr = 0644 << 16L
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        extra = self._align(zinfo, alignment) if alignment else ''
+        # We're extending ZipFile
+        # pylint: disable=attribute-defined-outside-init
+        self._didModify = True
+        # pylint: enable=attribute-defined-outside-init
+        self.fp.write(self._local_header(zinfo, extra))
+
+        crc = 0
+        size = 0
+        while True:
+            buf = fh.read(buf_size)
+            if not buf:
+                break
+            if indexer is not None:
+                buf = indexer.update(buf)
+            crc = zlib.crc32(buf, crc) & 0xffffffff
+            size += len(buf)
+            self.fp.write(buf)
+        if indexer is not None:
+            buf = indexer.flush()
+            crc = zlib.crc32(buf, crc) & 0xffffffff
+            size += len(buf)
+            self.fp.write(buf)
+        zinfo.CRC = crc
+        zinfo.file_size = zinfo.compress_size = size
+
+        # Back-patch the local header
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset)
+        self.fp.write(self._local_header(zinfo, extra))
+        self.fp.seek(position)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+
+class _MetadataCache(object):
+    '''A cache of the parsed contents of packages, keyed by URL and
+    validators.  Entries are kept in memory, and also on disk if
+    persistent is True.'''
+
+    def __init__(self, max_entries=64, persistent=False):
+        self.max_entries = max_entries
+        self.persistent = persistent
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def _root(self):
+        return os.path.join(get_pristine_cache_dir(), 'packages')
+
+    def key(self, source):
+        # Without validators we couldn't tell whether an entry is stale
+        etag = getattr(source, 'etag', None)
+        last_modified = getattr(source, 'last_modified', None)
+        if etag is None and last_modified is None:
+            return None
+        info = json.dumps({
+            'url': source.url,
+            'etag': etag,
+            'last-modified': last_modified.isoformat()
+                    if last_modified else None,
+            'length': getattr(source, 'length', None),
+        }, indent=2, sort_keys=True)
+        # Hash collisions will allow cache poisoning!
+        return sha256(info).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                return entry
+        if not self.persistent:
+            return None
+        try:
+            with open(os.path.join(self._root, key), 'r') as fh:
+                entry = json.load(fh)
+        except (IOError, ValueError):
+            return None
+        self._add(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self._add(key, entry)
+        if self.persistent:
+            ensure_dir(self._root)
+            path = os.path.join(self._root, key)
+            temp = '%s.%d.%d' % (path, os.getpid(),
+                    threading.current_thread().ident)
+            with open(temp, 'w') as fh:
+                json.dump(entry, fh)
+            rename(temp, path)
+
+    def _add(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# We want this to be a public attribute
+# pylint: disable=invalid-name
+metadata_cache = _MetadataCache()
+# pylint: enable=invalid-name
+
 
 class _IsrObject(object):
-    def __init__(self, url=None, size=None, username=None, password=None):
+    def __init__(self, url=None, size=None, username=None, password=None,
+            chunk_size=131072):
         class a:
             pass
         self.source = a()
@@ -87,43 +607,52 @@ class _IsrObject(object):
         self.length = size
         self.data = None
         self.offset = 0
-        self.chunk_size = 131072
+        self.chunk_size = chunk_size
 
 class Package(object):
     def __init__(self, source):
         self.url = source.url
+        # Base package, for delta packages
+        self.base_url = None
+        self.base = None
 
         parsed = urlsplit(self.url)
         if parsed.scheme == 'isr':
             self.name = parsed.path[1:]
-            from urlparse import urlunsplit
             server_url = urlunsplit(['http', parsed.netloc, self.name,
                 None, None])
+            descriptor = self._get_isr_descriptor(server_url,
+                    source.secret_key)
 
-            # domain xml
             self.domain = _IsrObject()
-            headers = {'X-Secret-Key': 'secret'}
-            response = requests.get(urljoin(server_url, '?type=xml'),
-                    headers=headers)
-            self.domain.data = response.content
-            # disk
-            disk_url = os.path.join(server_url, 'disk/chunk')
-            response = requests.get(os.path.join(server_url, 'disk/size'),
-                    headers=headers)
-            disk_size = int(response.text)
-            self.disk = _IsrObject(url=disk_url, size=disk_size)
-            # memory
-            memory_url = os.path.join(server_url, 'memory/chunk')
-            response = requests.get(os.path.join(server_url, 'memory/size'),
-                    headers=headers)
-            memory_size = int(response.text)
-            if memory_size > 0:
-                self.memory = _IsrObject(url=memory_url, size=memory_size)
+            self.domain.data = descriptor['domain_xml']
+            chunk_size = descriptor['chunk_size']
+            self.disk = _IsrObject(url=os.path.join(server_url, 'disk/chunk'),
+                    size=descriptor['disk_size'], chunk_size=chunk_size)
+            if descriptor['memory_size'] > 0:
+                self.memory = _IsrObject(
+                        url=os.path.join(server_url, 'memory/chunk'),
+                        size=descriptor['memory_size'], chunk_size=chunk_size)
             else:
                 self.memory = None
 
             return None
 
+        # Try metadata cache
+        key = metadata_cache.key(source)
+        entry = metadata_cache.get(key) if key is not None else None
+        if entry is not None:
+            self.name = entry['name']
+            self.base_url = entry.get('base_url')
+            self.domain = _cached_member(source, entry['domain'])
+            self.domain.data = base64.b64decode(entry['domain_data'])
+            self.disk = _cached_member(source, entry['disk'])
+            if entry['memory'] is not None:
+                self.memory = _cached_member(source, entry['memory'])
+            else:
+                self.memory = None
+            return
+
         # Read Zip
         try:
             zip = zipfile.ZipFile(source, 'r')
@@ -138,21 +667,178 @@ class Package(object):
             self.name = tree.get('name')
             self.domain = _PackageMember(zip,
                     tree.find(NSP + 'domain').get('path'), True)
-            self.disk = _PackageMember(zip,
-                    tree.find(NSP + 'disk').get('path'))
+            self.disk = self._load_image(zip, tree.find(NSP + 'disk'))
             memory = tree.find(NSP + 'memory')
             if memory is not None:
-                self.memory = _PackageMember(zip, memory.get('path'))
+                self.memory = self._load_image(zip, memory)
             else:
                 self.memory = None
+            base = tree.find(NSP + 'base')
+            if base is not None:
+                self.base_url = urljoin(self.url, base.get('url'))
         except etree.XMLSyntaxError, e:
             raise BadPackageError('Manifest XML does not validate', str(e))
         except (zipfile.BadZipfile, SourceError), e:
             raise BadPackageError(str(e))
 
+        # Update metadata cache
+        if key is not None:
+            metadata_cache.put(key, {
+                'name': self.name,
+                'domain': _member_desc(self.domain),
+                'domain_data': base64.b64encode(self.domain.data),
+                'disk': _member_desc(self.disk),
+                'memory': _member_desc(self.memory)
+                        if self.memory else None,
+                'base_url': self.base_url,
+            })
+
+    def load_base(self, scheme=None, username=None, password=None):
+        '''Open the base package of a delta package, so that chunks
+        unchanged from it can be read through the chunk indexes of this
+        one.  Returns the base package, or None if this is not a delta
+        package.'''
+        if self.base_url is None:
+            return None
+        if self.base is None:
+            base = Package(source_open(self.base_url, scheme=scheme,
+                    username=username, password=password))
+            for label in 'disk', 'memory':
+                member = getattr(self, label)
+                if member is None or member.chunks is None:
+                    continue
+                referenced = any(info.base is not None
+                        for info in member.chunks.chunks)
+                base_member = getattr(base, label)
+                if base_member is None or base_member.chunks is None:
+                    if referenced:
+                        raise BadPackageError('Base package has no chunk '
+                                'index for %s image' % label)
+                    continue
+                if base_member.chunks.chunk_size != \
+                        member.chunks.chunk_size:
+                    raise BadPackageError('Base package has chunk size %d '
+                            'for %s image; expected %d' %
+                            (base_member.chunks.chunk_size, label,
+                            member.chunks.chunk_size))
+                count = len(base_member.chunks)
+                for chunk, info in enumerate(member.chunks.chunks):
+                    if info.base is not None and info.base >= count:
+                        raise BadPackageError('Chunk %d of %s image refers '
+                                'to nonexistent base chunk %d' %
+                                (chunk, label, info.base))
+                member.chunks.base = base_member.chunks
+            self.base = base
+        return self.base
+
+    def read_page_index(self):
+        '''Return the QemuMemoryIndex of the memory image, or None if the
+        package does not have one.'''
+        member = getattr(self.memory, 'page_index', None)
+        if member is None:
+            return None
+        try:
+            fh = member.open()
+            try:
+                return QemuMemoryIndex.read(fh)
+            finally:
+                fh.close()
+        except MemoryImageError, e:
+            raise BadPackageError('Invalid memory page index', str(e))
+
+    @staticmethod
+    def _load_image(zip, el):
+        chunks = el.find(NSP + 'chunks')
+        if el.get('size') is not None:
+            # Stored as independently compressed chunks
+            if chunks is None:
+                raise BadPackageError('Compressed image "%s" has no chunk '
+                        'index' % el.get('path'))
+            frames = _PackageMember(zip, el.get('path'))
+            index = ChunkIndex.from_element(chunks, frames)
+            member = _chunked_member(index, int(el.get('size')),
+                    frames.alignment)
+            for info in index.chunks:
+                if (not info.zero and info.duplicate_of is None and
+                        info.base is None and info.offset is None):
+                    raise BadPackageError('Compressed image "%s" is '
+                            'missing chunk data' % el.get('path'))
+        else:
+            member = _PackageMember(zip, el.get('path'))
+            member.chunks = None
+        if chunks is not None and member.chunks is None:
+            data = chunks.get('path')
+            member.chunks = ChunkIndex.from_element(chunks,
+                    _PackageMember(zip, data) if data is not None else None)
+            member.chunks.member = member
+        if member.chunks is not None:
+            count = (member.length + member.chunks.chunk_size - 1) // \
+                    member.chunks.chunk_size
+            if len(member.chunks) != count:
+                raise BadPackageError('Chunk index for "%s" has %d entries; '
+                        'expected %d' % (el.get('path'), len(member.chunks),
+                        count))
+        pages = el.find(NSP + 'pages')
+        member.page_index = (_PackageMember(zip, pages.get('path'))
+                if pages is not None else None)
+        return member
+
+    @staticmethod
+    def _get_isr_descriptor(server_url, secret_key):
+        headers = {'X-Secret-Key': secret_key}
+        session = get_requests_session()
+        try:
+            response = session.get(os.path.join(server_url, 'descriptor'),
+                    headers=headers)
+            if response.status_code == 200:
+                descriptor = json.loads(response.text)
+                descriptor['domain_xml'] = \
+                        descriptor['domain_xml'].encode('utf-8')
+                return descriptor
+            elif response.status_code != 404:
+                raise BadPackageError('Could not fetch VM descriptor: %d' %
+                        response.status_code)
+
+            # Server predates the descriptor endpoint
+            descriptor = {'chunk_size': 131072}
+            response = session.get(urljoin(server_url, '?type=xml'),
+                    headers=headers)
+            response.raise_for_status()
+            descriptor['domain_xml'] = response.content
+            for image in 'disk', 'memory':
+                response = session.get(os.path.join(server_url,
+                        '%s/size' % image), headers=headers)
+                response.raise_for_status()
+                descriptor['%s_size' % image] = int(response.text)
+            return descriptor
+        except requests.RequestException, e:
+            raise BadPackageError('Could not fetch VM descriptor: %s' % e)
+        except (KeyError, ValueError), e:
+            raise BadPackageError('Invalid VM descriptor', str(e))
+
     @classmethod
-    def create(cls, out, name, domain_xml, disk_path, memory_path=None):
-        # Generate manifest XML
+    def create(cls, out, name, domain_xml, disk_path, memory_path=None,
+            alignment=DEFAULT_ALIGNMENT, chunk_index=False,
+            compress_chunks=False, base=None, page_index=False):
+        '''disk_path and memory_path can be paths or readable file objects,
+        such as pipes from a converter.  File objects are streamed into the
+        package without being staged elsewhere.  Disk and memory data
+        start at a multiple of alignment bytes within the package, unless
+        alignment is None.  If chunk_index is True, write a version 2
+        manifest with a per-chunk index of the disk and memory images.
+        compress_chunks implies chunk_index, and stores the images as
+        independently compressed chunks that can still be read randomly.
+        If base is a Package with chunk indexes, write a delta package
+        omitting chunks found in the corresponding images of base; this
+        implies chunk_index.  If page_index is True, parse the QEMU
+        migration stream in the memory image, which must be uncompressed,
+        and store a page-level index of it.'''
+        chunk_index = chunk_index or compress_chunks or base is not None
+        page_index = page_index and bool(memory_path)
+        zip = _PackageZipFile(out, 'w', zipfile.ZIP_STORED, True)
+        zip.comment = 'VMNetX package'
+
+        # Write manifest first unless it depends on the image data
         e = ElementMaker(namespace=NS, nsmap={None: NS})
         tree = e.image(
             e.domain(path=DOMAIN_FILENAME),
@@ -161,16 +847,58 @@ class Package(object):
         )
         if memory_path:
             tree.append(e.memory(path=MEMORY_FILENAME))
-        schema.assertValid(tree)
-        xml = etree.tostring(tree, encoding='UTF-8', pretty_print=True,
-                xml_declaration=True)
-
-        # Write package
-        zip = zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED, True)
-        zip.comment = 'VMNetX package'
-        zip.writestr(MANIFEST_FILENAME, xml)
+        if base is not None:
+            tree.append(e.base(url=base.url))
+        if not chunk_index and not page_index:
+            zip.writestr(MANIFEST_FILENAME, cls._manifest_xml(tree))
         zip.writestr(DOMAIN_FILENAME, domain_xml)
-        if memory_path is not None:
-            zip.write(memory_path, MEMORY_FILENAME)
-        zip.write(disk_path, DISK_FILENAME)
+
+        # Write images
+        for path, arcname, label in (
+                (memory_path, MEMORY_FILENAME, 'memory'),
+                (disk_path, DISK_FILENAME, 'disk')):
+            if path is None:
+                continue
+            base_member = getattr(base, label) if base is not None else None
+            indexer = (_ChunkIndexer(compress=compress_chunks,
+                    base=base_member.chunks if base_member else None)
+                    if chunk_index else None)
+            parser = (QemuMemoryParser()
+                    if page_index and label == 'memory' else None)
+            if hasattr(path, 'read'):
+                fh = path
+            else:
+                fh = open(path, 'rb')
+            try:
+                zip.write_stream(_ParsingReader(fh, parser)
+                        if parser is not None else fh, arcname,
+                        alignment=alignment, indexer=indexer)
+            finally:
+                if fh is not path:
+                    fh.close()
+            if indexer is not None:
+                for el in tree:
+                    if el.get('path') == arcname:
+                        el.append(indexer.finish().to_element(e))
+                        if indexer.chunked:
+                            el.set('size', str(indexer.size))
+            if parser is not None:
+                buf = StringIO()
+                parser.finish().write(buf)
+                zip.writestr(MEMORY_PAGE_INDEX_FILENAME, buf.getvalue())
+                for el in tree:
+                    if el.get('path') == arcname:
+                        el.append(e.pages(path=MEMORY_PAGE_INDEX_FILENAME))
+
+        # The chunk index can be large, so compress it
+        if chunk_index or page_index:
+            zip.writestr(zipfile.ZipInfo(MANIFEST_FILENAME,
+                    time.localtime()[0:6]), cls._manifest_xml(tree),
+                    zipfile.ZIP_DEFLATED)
         zip.close()
+
+    @staticmethod
+    def _manifest_xml(tree):
+        schema.assertValid(tree)
+        return etree.tostring(tree, encoding='UTF-8', pretty_print=True,
+                xml_declaration=True)
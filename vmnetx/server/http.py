@@ -98,11 +98,12 @@ class HttpServer(Flask):
 
         username = self._options['username']
         password = self._options['password']
+        cache_size = self._options['source_cache_size']
         try:
-            source = source_open(url)
+            source = source_open(url, cache_size=cache_size)
         except NeedAuthentication, e:
             source = source_open(url, scheme=e.scheme, username=username,
-                    password=password)
+                    password=password, cache_size=cache_size)
         package = Package(source)
         id, token = self._server.create_instance(package, user_ident)
 
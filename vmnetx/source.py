@@ -15,17 +15,26 @@
 # for more details.
 #
 
+from collections import deque
 from cookielib import Cookie
+import copy
 from datetime import datetime
 import dateutil.parser
 from dateutil.tz import tzutc
+import errno
+from hashlib import sha256
+import json
 import os
+import Queue
 import re
 import requests
+import threading
 from urllib import pathname2url
 from urlparse import urlsplit, urlunsplit
 
-from .util import NeedAuthentication, get_requests_session
+from .util import (NeedAuthentication, copy_fd_range, data_extents,
+        data_runs, ensure_dir, get_pristine_cache_dir, get_requests_session,
+        have_pwrite, pwrite, rename)
 
 class SourceError(Exception):
     '''_HttpSource would like to raise IOError on errors, but ZipFile swallows
@@ -33,11 +42,320 @@ class SourceError(Exception):
     pass
 
 
+class _BlockCache(object):
+    '''A persistent cache of fixed-size blocks of an HTTP resource, keyed
+    by URL and validators.  All resources share a size bound, which is
+    enforced by evicting the least-recently-used blocks.  The total size
+    is kept in a file at the top of the cache, so that the cache is only
+    scanned when it is created and when blocks are evicted.  The length
+    and validators most recently seen for each URL are recorded in the
+    resources directory, so that a reopened resource can be revalidated
+    without fetching its contents.'''
+
+    BLOCK_SIZE = 64 << 10
+    SIZE_FILE = 'size'
+    RESOURCES_DIR = 'resources'
+
+    def __init__(self, url, etag, last_modified, max_size):
+        self.block_size = self.BLOCK_SIZE
+        self._max_size = max_size
+        self._root = os.path.join(get_pristine_cache_dir(), 'blocks')
+        self._size_file = os.path.join(self._root, self.SIZE_FILE)
+        self._info = json.dumps({
+            'url': url,
+            'etag': etag,
+            'last-modified': last_modified.isoformat()
+                    if last_modified else None,
+        }, indent=2, sort_keys=True)
+        # Hash collisions will allow cache poisoning!
+        self._dir = os.path.join(self._root,
+                sha256(self._info).hexdigest())
+        self._size = self._read_size()
+        if self._size is None:
+            self._size = self._scan()[1]
+            self._write_size()
+        if self._size > self._max_size:
+            self._evict()
+
+    @classmethod
+    def _resource_path(cls, url):
+        return os.path.join(get_pristine_cache_dir(), 'blocks',
+                cls.RESOURCES_DIR, sha256(url).hexdigest())
+
+    @classmethod
+    def lookup(cls, url):
+        '''Return a dict of the length, etag, and Last-Modified header
+        last recorded for url, or None.'''
+        try:
+            with open(cls._resource_path(url)) as fh:
+                resource = json.load(fh)
+        except (IOError, ValueError):
+            return None
+        if resource.get('url') != url:
+            return None
+        return resource
+
+    def record(self, length, last_modified_header):
+        '''Record the length and validators of the resource, for
+        lookup().'''
+        info = json.loads(self._info)
+        resource = {
+            'url': info['url'],
+            'etag': info['etag'],
+            'last-modified': last_modified_header,
+            'length': length,
+            'dir': os.path.basename(self._dir),
+        }
+        if self.lookup(info['url']) == resource:
+            return
+        path = self._resource_path(info['url'])
+        ensure_dir(os.path.dirname(path))
+        temp = '%s.%d.%d' % (path, os.getpid(),
+                threading.current_thread().ident)
+        try:
+            with open(temp, 'w') as fh:
+                json.dump(resource, fh, indent=2, sort_keys=True)
+            rename(temp, path)
+        except (IOError, OSError):
+            pass
+
+    def _read_size(self):
+        try:
+            with open(self._size_file) as fh:
+                return int(fh.read())
+        except (IOError, ValueError):
+            return None
+
+    def _write_size(self):
+        # Other processes may update the size concurrently, so the value
+        # is approximate.  Eviction rescans the cache and corrects it.
+        ensure_dir(self._root)
+        temp = '%s.%d.%d' % (self._size_file, os.getpid(),
+                threading.current_thread().ident)
+        try:
+            with open(temp, 'w') as fh:
+                fh.write(str(self._size))
+            rename(temp, self._size_file)
+        except (IOError, OSError):
+            pass
+
+    def _add_size(self, count):
+        # Start from the stored size, which includes other processes'
+        # additions
+        size = self._read_size()
+        self._size = (size if size is not None else self._size) + count
+        if self._size > self._max_size:
+            self._evict()
+        else:
+            self._write_size()
+
+    def _scan(self):
+        entries = []
+        total = 0
+        if not os.path.isdir(self._root):
+            return entries, total
+        for dirpath, dirnames, filenames in os.walk(self._root):
+            if dirpath == self._root:
+                if self.RESOURCES_DIR in dirnames:
+                    dirnames.remove(self.RESOURCES_DIR)
+                continue
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return entries, total
+
+    def _evict(self):
+        entries, total = self._scan()
+        # Evict down to 90% of the limit so we don't rescan on every put
+        target = self._max_size * 9 // 10
+        dirs = set()
+        for _mtime, size, path in sorted(entries):
+            if total <= target:
+                break
+            if os.path.basename(path) == 'info':
+                continue
+            try:
+                os.unlink(path)
+                total -= size
+                dirs.add(os.path.dirname(path))
+            except OSError:
+                pass
+        # Remove directories left with only their info file, and the
+        # resource records that refer to them
+        for dirpath in dirs:
+            try:
+                names = os.listdir(dirpath)
+                if names == ['info']:
+                    info_file = os.path.join(dirpath, 'info')
+                    try:
+                        with open(info_file) as fh:
+                            url = json.load(fh)['url']
+                    except (IOError, KeyError, ValueError):
+                        url = None
+                    total -= os.stat(info_file).st_size
+                    os.unlink(info_file)
+                    os.rmdir(dirpath)
+                    if url is not None:
+                        resource = self.lookup(url)
+                        if (resource and resource.get('dir') ==
+                                os.path.basename(dirpath)):
+                            os.unlink(self._resource_path(url))
+            except OSError:
+                pass
+        self._size = total
+        self._write_size()
+
+    def get(self, block):
+        path = os.path.join(self._dir, str(block))
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+        except IOError:
+            return None
+        try:
+            # Record access for LRU eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, block, data):
+        if len(data) > self._max_size:
+            return
+        # Write URL and validators into directory for ease of debugging
+        ensure_dir(self._dir)
+        info_file = os.path.join(self._dir, 'info')
+        if not os.path.exists(info_file):
+            with open(info_file, 'w') as fh:
+                fh.write(self._info)
+            self._add_size(len(self._info))
+        path = os.path.join(self._dir, str(block))
+        temp = '%s.%d.%d' % (path, os.getpid(),
+                threading.current_thread().ident)
+        with open(temp, 'wb') as fh:
+            fh.write(data)
+        rename(temp, path)
+        self._add_size(len(data))
+
+
+class _PrefetchBlock(object):
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+        self.data = None
+        self.error = None
+        self.started = False
+        self.done = threading.Event()
+
+
+# We are a helper for _HttpSource and access its protected members
+# pylint: disable=protected-access
+class _Prefetcher(object):
+    '''Keeps up to depth Range requests in flight ahead of a sequential
+    reader, each on its own worker thread and HTTP session.  Completed
+    blocks are consumed in order.'''
+
+    def __init__(self, source, offset, block_size, depth):
+        self._source = source
+        self._block_size = block_size
+        self._depth = depth
+        # Next offset to be handed to the reader
+        self.offset = offset
+        # Next offset to be scheduled
+        self._next = offset
+        self._blocks = deque()
+        self._jobs = Queue.Queue()
+        self._threads = []
+        for _ in range(depth):
+            thread = threading.Thread(name='vmnetx-prefetch',
+                    target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._schedule()
+
+    def _schedule(self):
+        while (len(self._blocks) < self._depth and
+                self._next < self._source.length):
+            size = min(self._block_size, self._source.length - self._next)
+            block = _PrefetchBlock(self._next, size)
+            self._blocks.append(block)
+            self._jobs.put(block)
+            self._next += size
+
+    def _worker(self):
+        # Thread function.  requests.Session is not thread-safe, so each
+        # worker gets its own.
+        session = self._source._new_session()
+        try:
+            while True:
+                block = self._jobs.get()
+                if block is None:
+                    break
+                block.started = True
+                try:
+                    block.data = self._source._get(block.offset, block.size,
+                            session)
+                except SourceError, e:
+                    block.error = e
+                block.done.set()
+        finally:
+            session.close()
+
+    def read(self, minimum):
+        '''Return the data at self.offset, through the end of the first
+        block that completes at least minimum bytes.  Blocks only if that
+        data hasn't arrived yet.'''
+        stats = self._source._stats
+        chunks = []
+        count = 0
+        while (count < minimum or not chunks) and self._blocks:
+            block = self._blocks.popleft()
+            if not block.done.is_set():
+                stats['prefetch_waits'] += 1
+                block.done.wait()
+            if block.error is not None:
+                raise block.error
+            stats['prefetch_blocks'] += 1
+            stats['requests'] += 1
+            stats['bytes_fetched'] += len(block.data)
+            chunks.append(block.data)
+            count += len(block.data)
+            self._schedule()
+        self.offset += count
+        return ''.join(chunks)
+
+    def close(self):
+        # Drop requests that haven't started; let in-flight ones finish
+        # and discard their results
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except Queue.Empty:
+            pass
+        for _ in self._threads:
+            self._jobs.put(None)
+        self._source._stats['bytes_overfetched'] += sum(block.size
+                for block in self._blocks if block.started)
+        self._blocks.clear()
+# pylint: enable=protected-access
+
+
 class _HttpSource(object):
     '''A read-only file-like object backed by HTTP Range requests.'''
 
+    # Block cache key for the speculatively-fetched tail
+    TAIL_BLOCK = 'tail'
+
     def __init__(self, url, scheme=None, username=None, password=None,
-            buffer_size=64 << 10):
+            buffer_size=64 << 10, max_buffer_size=16 << 20,
+            pipeline_depth=0, pipeline_block_size=1 << 20, cache_size=0,
+            tail_size=0):
         if scheme == 'Basic':
             self._auth = (username, password)
         elif scheme == 'Digest':
@@ -55,13 +373,68 @@ class _HttpSource(object):
         self._buffer_size = buffer_size
         self._session = get_requests_session()
 
+        # Read-ahead state.  The window starts at buffer_size, doubles on
+        # each sequential read that goes to the network, and falls back to
+        # buffer_size on random access.
+        self._min_readahead = buffer_size
+        self._max_readahead = max(max_buffer_size, buffer_size)
+        self._readahead = buffer_size
+        self._sequential_offset = None
+        # Speculatively-fetched bytes in the buffer that haven't been
+        # returned to the caller (approximate; rereads are not tracked)
+        self._buffer_unused = 0
+
+        # Pipelined mode.  If pipeline_depth > 0, sequential reads are
+        # served from up to pipeline_depth concurrent Range requests of
+        # pipeline_block_size bytes each.
+        self._pipeline_depth = pipeline_depth
+        self._pipeline_block_size = pipeline_block_size
+        self._prefetcher = None
+
+        # On-disk block cache, enabled below if cache_size > 0 and the
+        # server provides validators
+        self._cache = None
+
+        # Counters for tuning
+        self._stats = {
+            'cases': dict((case, 0) for case in 'BCDEF'),
+            'requests': 0,
+            'bytes_fetched': 0,
+            'bytes_overfetched': 0,
+            'prefetch_blocks': 0,
+            'prefetch_waits': 0,
+            'cache_hits': 0,
+            'cache_misses': 0,
+        }
+
         # Debugging
         self._last_case = None
         self._last_network = None
 
-        # Perform HEAD request
+        # If tail_size > 0, speculatively fetch the tail of the object,
+        # where ZipFile will look for the central directory, and take the
+        # object length and validators from that response.  If the block
+        # cache has seen the object before, make the request conditional,
+        # so that an unchanged tail is read from the cache.  Otherwise
+        # perform a HEAD request.
         try:
-            resp = self._session.head(self.url, auth=self._auth)
+            cached = None
+            if tail_size > 0:
+                headers = {
+                    'Range': 'bytes=-%d' % tail_size,
+                }
+                if cache_size > 0:
+                    cached = _BlockCache.lookup(self.url)
+                if cached and cached['etag']:
+                    headers['If-None-Match'] = cached['etag']
+                elif cached and cached['last-modified']:
+                    headers['If-Modified-Since'] = cached['last-modified']
+                else:
+                    cached = None
+                resp = self._session.get(self.url, auth=self._auth,
+                        headers=headers, stream=True)
+            else:
+                resp = self._session.head(self.url, auth=self._auth)
 
             # Check for missing credentials
             if resp.status_code == 401:
@@ -78,22 +451,65 @@ class _HttpSource(object):
                         raise NeedAuthentication(host, match.group(1), scheme)
                 raise SourceError('Unknown authentication realm')
 
-            # Check for other errors
-            resp.raise_for_status()
-            # 2xx codes other than 200 are unexpected
-            if resp.status_code != 200:
-                raise SourceError('Unexpected status code %d' %
-                        resp.status_code)
+            tail = ''
+            last_modified_header = resp.headers.get('Last-Modified')
+            if cached and resp.status_code == 304:
+                # Unchanged since it was cached
+                resp.close()
+                self.length = cached['length']
+                last_modified_header = cached['last-modified']
+            elif tail_size > 0 and resp.status_code in (206, 416):
+                # Partial content, or a zero-length object.  Store object
+                # length from Content-Range.
+                self.length = self._get_content_range_length(resp)
+                if resp.status_code == 206:
+                    tail = resp.content
+                    self._stats['requests'] += 1
+                    self._stats['bytes_fetched'] += len(tail)
+            else:
+                # Check for other errors
+                resp.raise_for_status()
+                # 2xx codes other than 200 are unexpected
+                if resp.status_code != 200:
+                    raise SourceError('Unexpected status code %d' %
+                            resp.status_code)
+                # If the server ignored our Range header, don't download
+                # the whole object
+                if tail_size > 0:
+                    resp.close()
 
-            # Store object length
-            try:
-                self.length = int(resp.headers['Content-Length'])
-            except (IndexError, ValueError):
-                raise SourceError('Server did not provide Content-Length')
+                # Store object length
+                try:
+                    self.length = int(resp.headers['Content-Length'])
+                except (IndexError, ValueError):
+                    raise SourceError('Server did not provide ' +
+                            'Content-Length')
 
             # Store validators
-            self.etag = self._get_etag(resp)
-            self.last_modified = self._get_last_modified(resp)
+            if cached and resp.status_code == 304:
+                self.etag = cached['etag']
+            else:
+                self.etag = self._get_etag(resp)
+            self.last_modified = self._parse_last_modified(
+                    last_modified_header)
+
+            # Set up block cache.  Without validators we couldn't tell
+            # whether cached data is stale.
+            if cache_size > 0 and (self.etag or self.last_modified):
+                self._cache = _BlockCache(self.url, self.etag,
+                        self.last_modified, cache_size)
+                self._cache.record(self.length, last_modified_header)
+                # Keep the tail for the next open
+                if tail:
+                    self._cache.put(self.TAIL_BLOCK, tail)
+                elif cached and resp.status_code == 304:
+                    tail = self._cache.get(self.TAIL_BLOCK) or ''
+                    if len(tail) > self.length:
+                        tail = ''
+
+            # Seed buffer with the speculatively-fetched tail
+            if tail:
+                self._set_buffer(tail, self.length - len(tail), len(tail))
 
             # Record cookies
             if hasattr(self._session.cookies, 'extract_cookies'):
@@ -124,14 +540,39 @@ class _HttpSource(object):
     def name(self):
         return '<%s>' % self.url
 
+    def dup(self):
+        '''Return an independent source for the same object, with its own
+        connection and buffer, without contacting the server.'''
+        other = copy.copy(self)
+        other._session = self._new_session()
+        other._offset = 0
+        other._closed = False
+        other._buffer = ''
+        other._buffer_offset = 0
+        other._buffer_unused = 0
+        other._readahead = self._min_readahead
+        other._sequential_offset = None
+        other._prefetcher = None
+        other._stats = copy.deepcopy(self._stats)
+        return other
+
     def _get_etag(self, resp):
         etag = resp.headers.get('ETag')
         if etag is None or etag.startswith('W/'):
             return None
         return etag
 
+    def _get_content_range_length(self, resp):
+        content_range = resp.headers.get('Content-Range', '')
+        match = re.match(r'^bytes (?:\d+-\d+|\*)/(\d+)$', content_range)
+        if not match:
+            raise SourceError('Server did not provide object length')
+        return int(match.group(1))
+
     def _get_last_modified(self, resp):
-        last_modified = resp.headers.get('Last-Modified')
+        return self._parse_last_modified(resp.headers.get('Last-Modified'))
+
+    def _parse_last_modified(self, last_modified):
         if last_modified is None:
             return None
         try:
@@ -139,13 +580,90 @@ class _HttpSource(object):
         except ValueError:
             return None
 
-    def _get(self, offset, size):
+    @property
+    def stats(self):
+        '''Return a snapshot of the read-ahead counters.'''
+        stats = dict(self._stats)
+        stats['cases'] = dict(self._stats['cases'])
+        stats['readahead'] = self._readahead
+        return stats
+
+    def _update_readahead(self, sequential):
+        if sequential:
+            self._readahead = min(self._readahead * 2, self._max_readahead)
+        else:
+            self._readahead = self._min_readahead
+
+    def _set_buffer(self, data, offset, unused):
+        # Account for read-ahead that was never consumed
+        self._stats['bytes_overfetched'] += max(self._buffer_unused, 0)
+        self._buffer = data
+        self._buffer_offset = offset
+        self._buffer_unused = unused
+
+    def _new_session(self):
+        session = get_requests_session()
+        if hasattr(session.cookies, 'set_cookie'):
+            for cookie in self.cookies:
+                session.cookies.set_cookie(cookie)
+        return session
+
+    def _get(self, offset, size, session=None):
+        if self._cache is None:
+            return self._get_range(offset, size, session)
+
+        # Satisfy the request in whole cache blocks, fetching each run of
+        # missing blocks with a single Range request
+        end = min(offset + size, self.length)
+        if end <= offset:
+            return ''
+        block_size = self._cache.block_size
+        first = offset // block_size
+        last = (end - 1) // block_size
+        chunks = []
+        missing = None
+        for block in xrange(first, last + 1):
+            data = self._cache.get(block)
+            if data is None:
+                if missing is None:
+                    missing = block
+                continue
+            if session is None:
+                self._stats['cache_hits'] += 1
+            if missing is not None:
+                chunks.append(self._get_blocks(missing, block, session))
+                missing = None
+            chunks.append(data)
+        if missing is not None:
+            chunks.append(self._get_blocks(missing, last + 1, session))
+        start = offset - first * block_size
+        return ''.join(chunks)[start:start + size]
+
+    def _get_blocks(self, first, end, session):
+        # Fetch cache blocks [first, end) and store them in the cache
+        block_size = self._cache.block_size
+        start = first * block_size
+        data = self._get_range(start,
+                min(end * block_size, self.length) - start, session)
+        for block in xrange(first, end):
+            offset = (block - first) * block_size
+            self._cache.put(block, data[offset:offset + block_size])
+        if session is None:
+            self._stats['cache_misses'] += end - first
+        return data
+
+    def _get_range(self, offset, size, session=None):
+        # Requests on a session other than our own come from prefetch
+        # worker threads, which must not touch the counters
         range = '%d-%d' % (offset, offset + size - 1)
-        self._last_network = range
+        if session is None:
+            session = self._session
+            self._last_network = range
+            self._stats['requests'] += 1
         range = 'bytes=' + range
 
         try:
-            resp = self._session.get(self.url, auth=self._auth, headers={
+            resp = session.get(self.url, auth=self._auth, headers={
                 'Range': range,
             })
             resp.raise_for_status()
@@ -154,45 +672,71 @@ class _HttpSource(object):
             if (self._get_etag(resp) != self.etag or
                     self._get_last_modified(resp) != self.last_modified):
                 raise SourceError('Resource changed on server')
+            if session is self._session:
+                self._stats['bytes_fetched'] += len(resp.content)
             return resp.content
         except requests.exceptions.RequestException, e:
             raise SourceError(str(e))
 
-    def read(self, size=None):
+    def _fetch(self, offset, size, sequential):
+        '''Return at least size bytes at offset (unless at EOF), plus
+        read-ahead.'''
+        if self._pipeline_depth > 0 and sequential:
+            if (self._prefetcher is None or
+                    self._prefetcher.offset != offset):
+                self._stop_prefetch()
+                self._prefetcher = _Prefetcher(self, offset,
+                        self._pipeline_block_size, self._pipeline_depth)
+            return self._prefetcher.read(size)
+        self._stop_prefetch()
+        return self._get(offset, size + self._readahead)
+
+    def _stop_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def _read(self, size):
+        # Returns a list of memoryviews over the data, so that callers can
+        # copy it exactly once
         if self.closed:
             raise SourceError('File is closed')
         if size is None:
             size = self.length - self._offset
+        sequential = self._offset == self._sequential_offset
         buf_start = self._buffer_offset
         buf_end = self._buffer_offset + len(self._buffer)
         if self._offset >= buf_start and self._offset + size <= buf_end:
             # Case B: Satisfy entirely from buffer
             self._last_case = 'B'
             start = self._offset - self._buffer_offset
-            ret = self._buffer[start:start + size]
+            ret = [memoryview(self._buffer)[start:start + size]]
         elif self._offset >= buf_start and self._offset < buf_end:
             # Case C: Satisfy head from buffer
-            # Buffer becomes _buffer_size bytes after requested region
+            # Buffer becomes read-ahead window after requested region
             self._last_case = 'C'
-            ret = self._buffer[self._offset - buf_start:]
-            remaining = size - len(ret)
-            data = self._get(self._offset + len(ret), remaining +
-                    self._buffer_size)
-            ret += data[:remaining]
-            self._buffer = data[remaining:]
-            self._buffer_offset = self._offset + size
+            self._update_readahead(sequential)
+            head = memoryview(self._buffer)[self._offset - buf_start:]
+            self._buffer_unused -= len(head)
+            remaining = size - len(head)
+            data = self._fetch(self._offset + len(head), remaining,
+                    sequential)
+            ret = [head, memoryview(data)[:remaining]]
+            self._set_buffer(data[remaining:], self._offset + size,
+                    len(data) - remaining)
         elif (self._offset < buf_start and
                 self._offset + size >= buf_start):
             # Case D: Satisfy tail from buffer
             # Buffer becomes _buffer_size bytes before requested region
             # plus requested region
             self._last_case = 'D'
+            self._update_readahead(False)
             tail = self._buffer[:self._offset + size - buf_start]
+            self._buffer_unused -= len(tail)
             start = max(self._offset - self._buffer_size, 0)
             data = self._get(start, buf_start - start)
-            self._buffer = data + tail
-            self._buffer_offset = start
-            ret = self._buffer[self._offset - start:]
+            self._set_buffer(data + tail, start, self._offset - start)
+            ret = [memoryview(self._buffer)[self._offset - start:]]
         else:
             # Buffer is useless
             if self._offset + size >= self.length:
@@ -201,22 +745,45 @@ class _HttpSource(object):
                 # Buffer becomes _buffer_size bytes before requested
                 # region plus requested region
                 self._last_case = 'E'
+                self._update_readahead(False)
                 start = max(self._offset - self._buffer_size, 0)
-                self._buffer = self._get(start,
-                        self._offset + size - start)
-                self._buffer_offset = start
-                ret = self._buffer[self._offset - start:]
+                self._set_buffer(self._get(start,
+                        self._offset + size - start), start,
+                        self._offset - start)
+                ret = [memoryview(self._buffer)[self._offset - start:]]
             else:
                 # Case F: Read unrelated to previous reads.
-                # Buffer becomes _buffer_size bytes after requested region
+                # Buffer becomes read-ahead window after requested region
                 self._last_case = 'F'
-                data = self._get(self._offset, size + self._buffer_size)
-                ret = data[:size]
-                self._buffer = data[size:]
-                self._buffer_offset = self._offset + size
-        self._offset += len(ret)
+                self._update_readahead(sequential)
+                data = self._fetch(self._offset, size, sequential)
+                ret = [memoryview(data)[:size]]
+                self._set_buffer(data[size:], self._offset + size,
+                        len(data) - size)
+        count = sum(len(view) for view in ret)
+        if self._last_case == 'B':
+            self._buffer_unused -= count
+        self._stats['cases'][self._last_case] += 1
+        self._offset += count
+        self._sequential_offset = self._offset
         return ret
 
+    def read(self, size=None):
+        ret = self._read(size)
+        if len(ret) == 1:
+            return ret[0].tobytes()
+        return ''.join(view.tobytes() for view in ret)
+
+    def readinto(self, b):
+        '''Read up to len(b) bytes into the writable buffer b, copying each
+        byte only once.  Returns the number of bytes read.'''
+        out = memoryview(b)
+        count = 0
+        for view in self._read(len(out)):
+            out[count:count + len(view)] = view
+            count += len(view)
+        return count
+
     def seek(self, offset, whence=0):
         if self.closed:
             raise SourceError('File is closed')
@@ -235,7 +802,8 @@ class _HttpSource(object):
 
     def close(self):
         self._closed = True
-        self._buffer = ''
+        self._stop_prefetch()
+        self._set_buffer('', 0, 0)
         self._session.close()
 
     @property
@@ -268,9 +836,33 @@ class _FileSource(file):
         self.last_modified = datetime.fromtimestamp(
                 int(os.fstat(self.fileno()).st_mtime), tzutc())
 
+    def dup(self):
+        '''Return an independent file handle for the same file.'''
+        return _FileSource(self.url)
+
+
+class _IsrSource(object):
+    '''Placeholder source for an ISR server VM.  Package fetches the VM's
+    descriptor from the server itself, authenticating with secret_key.'''
+
+    def __init__(self, url, secret_key=None):
+        self.url = url
+        self.cookies = ()
+        self.etag = None
+        self.last_modified = None
+        self.secret_key = secret_key or DEFAULT_ISR_SECRET_KEY
+
+
+# Enough for ZipFile to find the end of central directory record behind a
+# short archive comment, plus the central directory of a typical package
+OPEN_TAIL_SIZE = 64 << 10
+
+# Used by ISR servers that have not been configured with per-user keys
+DEFAULT_ISR_SECRET_KEY = 'secret'
+
 
 def source_open(url=None, scheme=None, username=None, password=None,
-        filename=None):
+        filename=None, cache_size=0, secret_key=None):
     if filename:
         url = urlunsplit(('file', '',
                 pathname2url(os.path.abspath(filename)), '', ''))
@@ -279,14 +871,12 @@ def source_open(url=None, scheme=None, username=None, password=None,
         parsed = urlsplit(url)
         if parsed.scheme == 'http' or parsed.scheme == 'https':
             return _HttpSource(url, scheme=scheme, username=username,
-                    password=password)
+                    password=password, cache_size=cache_size,
+                    tail_size=OPEN_TAIL_SIZE)
         elif parsed.scheme == 'file':
             return _FileSource(url)
         elif parsed.scheme == 'isr':
-            class _s:
-                def __init__(self, url):
-                    self.url = url
-            return _s(url)
+            return _IsrSource(url, secret_key)
         else:
             raise ValueError('%s: URLs not supported' % parsed.scheme)
 
@@ -309,17 +899,222 @@ class SourceRange(object):
         else:
             self.data = None
 
-    def write_to_file(self, fh, buf_size=1 << 20):
+    @property
+    def local_path(self):
+        '''The path of the local file holding the range in place at
+        self.offset, or None if there isn't one.'''
+        if isinstance(self.source, _FileSource):
+            return self.source.name
+        return None
+
+    def open(self):
+        '''Return a read-only file-like view of the range, with its own
+        position in an independent source.'''
+        return _RangeFile(self)
+
+    def write_to_file(self, fh, buf_size=1 << 20, segments=1, progress=None,
+            sparse=False):
+        '''Copy the range to the current position of fh.  If segments > 1,
+        split the range into that many segments and copy them concurrently
+        through independent sources, holding at most one buffer per
+        segment in memory.  If progress is specified, it is called
+        periodically with the number of bytes copied so far and the total.
+        If sparse is True, fh must be a regular file with no data beyond
+        its current position; zero blocks are skipped rather than written,
+        leaving holes, and holes in a local source are not read.'''
         if self.data is not None:
             fh.write(self.data)
-        else:
-            self.source.seek(self.offset)
-            count = self.length
-            while count > 0:
-                cur = min(count, buf_size)
-                buf = self.source.read(cur)
-                fh.write(buf)
-                count -= len(buf)
+            if progress is not None:
+                progress(self.length, self.length)
+            return
+
+        if isinstance(self.source, _FileSource):
+            # Have the kernel copy the data
+            fh.flush()
+            out_fd = fh.fileno()
+            base = fh.tell()
+            extents = None
+            if sparse:
+                extents = data_extents(self.source.fileno(), self.offset,
+                        self.length)
+            if extents is None:
+                extents = [(self.offset, self.offset + self.length)]
+            try:
+                for start, end in extents:
+                    os.lseek(out_fd, base + start - self.offset, os.SEEK_SET)
+                    copied = copy_fd_range(self.source.fileno(), start,
+                            out_fd, end - start)
+                    if copied != end - start:
+                        raise SourceError('Unexpected end of file')
+                    if progress is not None:
+                        progress(end - self.offset, self.length)
+            except OSError, e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                    raise
+                # Copy through userspace instead
+                fh.seek(base)
+            else:
+                self._finish_file(fh, base + self.length, sparse)
+                if progress is not None:
+                    progress(self.length, self.length)
+                return
+
+        if segments > 1 and self.length > buf_size and have_pwrite():
+            self._write_segmented(fh, buf_size, segments, progress, sparse)
+            return
+
+        # Read into a preallocated buffer and write from it
+        buf = memoryview(bytearray(min(buf_size, self.length)))
+        self.source.seek(self.offset)
+        base = fh.tell()
+        count = self.length
+        while count > 0:
+            cur = min(count, buf_size)
+            read = self.source.readinto(buf[:cur])
+            if not read:
+                raise SourceError('Unexpected end of file')
+            if sparse:
+                position = base + self.length - count
+                for start, end in data_runs(buf, read):
+                    fh.seek(position + start)
+                    fh.write(buf[start:end])
+            else:
+                fh.write(buf[:read])
+            count -= read
+            if progress is not None:
+                progress(self.length - count, self.length)
+        if sparse:
+            self._finish_file(fh, base + self.length, sparse)
+
+    @staticmethod
+    def _finish_file(fh, end, sparse):
+        # Leave fh at the end of the copied range, extending the file over
+        # any trailing hole
+        if sparse:
+            fh.flush()
+            if os.fstat(fh.fileno()).st_size < end:
+                fh.truncate(end)
+        fh.seek(end)
+
+    def _write_segmented(self, fh, buf_size, segments, progress, sparse):
+        fh.flush()
+        out_fd = fh.fileno()
+        base = fh.tell()
+        # Segments are multiples of buf_size, except the last
+        blocks = (self.length + buf_size - 1) // buf_size
+        segments = min(segments, blocks)
+        per_segment = (blocks + segments - 1) // segments * buf_size
+        results = Queue.Queue()
+        abort = threading.Event()
+
+        def worker(start, end):
+            # Thread function.  Reports progress and errors through the
+            # results queue.
+            try:
+                source = self.source.dup()
+                try:
+                    buf = bytearray(min(buf_size, end - start))
+                    view = memoryview(buf)
+                    source.seek(self.offset + start)
+                    offset = start
+                    while offset < end and not abort.is_set():
+                        cur = min(end - offset, buf_size)
+                        read = source.readinto(view[:cur])
+                        if not read:
+                            raise SourceError('Unexpected end of file')
+                        if sparse:
+                            for run_start, run_end in data_runs(buf, read):
+                                pwrite(out_fd, buf, run_end - run_start,
+                                        base + offset + run_start, run_start)
+                        else:
+                            pwrite(out_fd, buf, read, base + offset)
+                        offset += read
+                        results.put(read)
+                finally:
+                    source.close()
+            # Reraised in the calling thread
+            # pylint: disable=broad-except
+            except Exception, e:
+                results.put(e)
+            # pylint: enable=broad-except
+            results.put(None)
+
+        threads = []
+        for start in xrange(0, self.length, per_segment):
+            thread = threading.Thread(name='vmnetx-extract',
+                    target=worker,
+                    args=(start, min(start + per_segment, self.length)))
+            thread.start()
+            threads.append(thread)
+
+        error = None
+        done = 0
+        running = len(threads)
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item, Exception):
+                abort.set()
+                if error is None:
+                    error = item
+            else:
+                done += item
+                if progress is not None:
+                    progress(done, self.length)
+        for thread in threads:
+            thread.join()
+        if error is not None:
+            raise error
+        self._finish_file(fh, base + self.length, sparse)
+
+
+class _RangeFile(object):
+    '''A read-only file-like view of a SourceRange.'''
+
+    def __init__(self, range):
+        self._range = range
+        self._source = range.source.dup()
+        self._offset = 0
+        self.name = '<%s range %d+%d>' % (range.source.url, range.offset,
+                range.length)
+
+    def read(self, size=None):
+        remaining = self._range.length - self._offset
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        self._source.seek(self._range.offset + self._offset)
+        data = self._source.read(size)
+        self._offset += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        memoryview(b)[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._offset
+        elif whence == 2:
+            offset += self._range.length
+        elif whence != 0:
+            raise IOError('Invalid whence')
+        if offset < 0:
+            raise IOError('Invalid offset')
+        self._offset = offset
+
+    def tell(self):
+        return self._offset
+
+    def close(self):
+        self._source.close()
+
+    @property
+    def closed(self):
+        return self._source.closed
 
 
 # We access protected members in assertions.
@@ -365,8 +1160,8 @@ def _main():
             # Case B
             try_read(fh, 2, 'B', data[18:20], 20, data[18:22], 18)
 
-            # Case C
-            try_read(fh, 6, 'C', data[20:26], 26, data[26:30], 26, '22-29')
+            # Case C (sequential, so the read-ahead window doubles)
+            try_read(fh, 6, 'C', data[20:26], 26, data[26:34], 26, '22-33')
 
             # Case D
             fh.seek(-4, 1)
@@ -394,6 +1189,43 @@ def _main():
             # EOF
             try_read(fh, None, 'B', '', len(data), data, 0)
 
+        with _HttpSource('http://localhost:8080/test.txt',
+                buffer_size=4, max_buffer_size=16) as fh:
+            # Read-ahead grows on sequential access up to the cap
+            try_read(fh, 2, 'F', data[0:2], 2, data[2:6], 2, '0-5')
+            try_read(fh, 6, 'C', data[2:8], 8, data[8:16], 8, '6-15')
+            try_read(fh, 10, 'C', data[8:18], 18, data[18:34], 18, '16-33')
+            try_read(fh, 20, 'C', data[18:38], 38, data[38:52], 38, '34-53')
+            assert fh.stats['readahead'] == 16
+            # ...and shrinks again on random access
+            fh.seek(4)
+            try_read(fh, 2, 'F', data[4:6], 6, data[6:10], 6, '4-9')
+            assert fh.stats['readahead'] == 4
+            assert fh.stats['requests'] == 5
+            assert fh.stats['cases']['C'] == 3
+
+        with _HttpSource('http://localhost:8080/test.txt',
+                buffer_size=4, pipeline_depth=2,
+                pipeline_block_size=8) as fh:
+            # Sequential reads are served from prefetched blocks
+            try_read(fh, 2, 'F', data[0:2], 2, data[2:6], 2, '0-5')
+            try_read(fh, 6, 'C', data[2:8], 8, data[8:14], 8)
+            try_read(fh, 20, 'C', data[8:28], 28, data[28:30], 28)
+            assert fh.stats['prefetch_blocks'] == 3
+            # Random access bypasses the pipeline
+            fh.seek(40)
+            try_read(fh, 2, 'F', data[40:42], 42, data[42:46], 42, '40-45')
+
+        with _HttpSource('http://localhost:8080/test.txt',
+                buffer_size=4, tail_size=8) as fh:
+            # Speculative tail fetch instead of HEAD
+            assert fh.length == len(data)
+            assert fh._buffer == data[-8:]
+            assert fh._buffer_offset == len(data) - 8
+            fh.seek(-5, 2)
+            try_read(fh, 5, 'B', data[-5:], len(data), data[-8:],
+                    len(data) - 8)
+
         with _HttpSource('http://localhost:8080/test.txt',
                 buffer_size=4) as fh:
             # Change detection
@@ -30,12 +30,12 @@ import distutils.dir_util
 import sys
 import urllib
 import uuid
-import requests
 from urlparse import urljoin, urlsplit, urlunsplit
 import vmnetx.ui
 
 from ..controller import ChunkStateArray
-from ..util import ErrorBuffer, BackoffTimer, get_modified_cache_dir
+from ..util import (ErrorBuffer, BackoffTimer, get_modified_cache_dir,
+        get_requests_session)
 from ..source import source_open
 from ..package import Package
 from ..controller.local import _Image, VMNetFS, LocalController
@@ -1760,6 +1760,7 @@ class IsrWindow(gtk.Window):
 
         # TODO: correct user auth and stuff
         self._headers = {'X-Secret-Key': 'secret'}
+        self._session = get_requests_session()
 
         # main menu
         menubar = self._get_main_menu()
@@ -1885,7 +1886,7 @@ class IsrWindow(gtk.Window):
     def _validate_cache(self, current_version, new_version):
         url = urljoin(self._selected_server, 'vm/%s/%s/%s' %
                 (self._selected_vm, current_version, new_version))
-        response = requests.get(url, headers=self._headers)
+        response = self._session.get(url, headers=self._headers)
         chunk_list = json.loads(response.text)
         for image in chunk_list:
             cache = _Image.get_pristine_cache_path(self._selected_vm)
@@ -1909,7 +1910,7 @@ class IsrWindow(gtk.Window):
         def checkout():
             url = urljoin(self._selected_server, 'vm/checkout/%s' % (self._selected_vm))
             payload = {'machine name': self._machine_name}
-            response = requests.post(url, data=json.dumps(payload),
+            response = self._session.post(url, data=json.dumps(payload),
                     headers=self._headers)
             if response.status_code == 200:
                 selected_vm['Key'] = response.text
@@ -1922,8 +1923,8 @@ class IsrWindow(gtk.Window):
                 ew.destroy()
                 if response == gtk.RESPONSE_CANCEL:
                     payload['force'] = True
-                    response = requests.post(url, data=json.dumps(payload),
-                        headers=self._headers)
+                    response = self._session.post(url,
+                            data=json.dumps(payload), headers=self._headers)
                     if response.status_code == 200:
                         selected_vm['Key'] = response.text
                         return True
@@ -1975,7 +1976,7 @@ class IsrWindow(gtk.Window):
             url = urljoin(self._selected_server, 'vm/discard/%s' %
                     self._selected_vm)
             payload = {'key': selected_vm['Key']}
-            response = requests.post(url, headers=self._headers,
+            response = self._session.post(url, headers=self._headers,
                     data=json.dumps(payload))
 
         elif button == 'Checkin':
@@ -1986,7 +1987,7 @@ class IsrWindow(gtk.Window):
             # if there are no local changes, only release the lock
             if not selected_vm['Local changes']:
                 payload = {'key': selected_vm['Key']}
-                response = requests.post(url, headers=self._headers,
+                response = self._session.post(url, headers=self._headers,
                         data=json.dumps(payload))
                 self.emit('toolbar-clicked', button)
                 selected_vm['Key'] = ''
@@ -2005,8 +2006,8 @@ class IsrWindow(gtk.Window):
                 if comment_wind.run() == gtk.RESPONSE_OK:
                     payload = {'comment': comment_wind.comment,
                            'key': selected_vm['Key']}
-                    response = requests.post(comment_url, headers=self._headers,
-                            data=json.dumps(payload))
+                    response = self._session.post(comment_url,
+                            headers=self._headers, data=json.dumps(payload))
                     if response.status_code != 200:
                         ew = IgnorableErrorWindow(self,
                                 'Server error: ' + response.text)
@@ -2024,9 +2025,11 @@ class IsrWindow(gtk.Window):
                 disk_url = urljoin(url + '/', 'disk/size')
                 memory_url = urljoin(url + '/', 'memory/size')
                 with open(os.path.join(disk_cache, 'size'), 'r') as file:
-                    requests.post(disk_url, data=file.read(), headers=self._headers)
+                    self._session.post(disk_url, data=file.read(),
+                            headers=self._headers)
                 with open(os.path.join(memory_cache, 'size'), 'r') as file:
-                    requests.post(memory_url, data=file.read(), headers=self._headers)
+                    self._session.post(memory_url, data=file.read(),
+                            headers=self._headers)
                 # TODO: Check which chunks are missing on the server before
                 # sending all of them
 
@@ -2035,7 +2038,8 @@ class IsrWindow(gtk.Window):
                 isr_url = urlunsplit(('isr', urlsplit(self._selected_server).netloc,
                     'vm/%s/%s' % (self._selected_vm, version), '', ''))
                 self._cont = LocalController(url=isr_url, checkin=True,
-                        throttle_rate='1.0') # self._pref['throttle-rate'])
+                        throttle_rate='1.0', # self._pref['throttle-rate'])
+                        secret_key=self._headers['X-Secret-Key'])
                 self._cont.connect('checkin-progress', self._checkin_progress)
                 self._cont.setup_environment()
                 self._cont.initialize()
@@ -2072,7 +2076,7 @@ class IsrWindow(gtk.Window):
             url = urljoin(self._selected_server, 'vm/commit/%s' %
                         (self._selected_vm))
             payload = {'key': selected_vm['Key']}
-            response = requests.post(url, headers=self._headers,
+            response = self._session.post(url, headers=self._headers,
                     data=json.dumps(payload))
 
             # Move modified cache chunks to pristine cache
@@ -2170,7 +2174,7 @@ class IsrWindow(gtk.Window):
     def _version_dialog(self, _action, _wid):
         # fetch vm information from server
         url = urljoin(self._selected_server, 'vm/version/%s' % self._selected_vm)
-        response = requests.get(url, headers=self._headers)
+        response = self._session.get(url, headers=self._headers)
         data = json.loads(response.text)
 
         RESPONSE_RESUME = 1234
@@ -2201,13 +2205,14 @@ class IsrWindow(gtk.Window):
     def _create_dialog(self, _action, _wid):
         url = urljoin(self._selected_server, 'vm/base_info')
         # TODO: Real secrets
-        response = requests.get(url, headers=self._headers)
+        response = self._session.get(url, headers=self._headers)
         base_vm_info = json.loads(response.text)
         create_wind = CreateWindow(base_vm_info)
         if create_wind.run() == gtk.RESPONSE_OK:
             url = urljoin(self._selected_server, 'vm/create')
             payload = {'uuid': create_wind.uuid, 'name': create_wind.name}
-            response = requests.post(url, data=payload, headers=self._headers)
+            response = self._session.post(url, data=payload,
+                    headers=self._headers)
             if response.status_code != 200:
                 print response.text
         create_wind.destroy()
@@ -2309,7 +2314,7 @@ class IsrWindow(gtk.Window):
 
         url = urljoin(self._selected_server, 'vm/info')
         try:
-            response = requests.get(url, headers=self._headers)
+            response = self._session.get(url, headers=self._headers)
             if response.status_code != 200:
                 ew = IgnorableErrorWindow(self,
                     'Could not fetch vm list from server')
@@ -2346,7 +2351,7 @@ class IsrWindow(gtk.Window):
             if button in ['Refresh', 'Checkin', 'Checkout']:
                 # Update fields from the server
                 url = urljoin(self._selected_server, 'vm/info')
-                response = requests.get(url, headers=self._headers)
+                response = self._session.get(url, headers=self._headers)
                 vm_info = json.loads(response.text,
                         object_pairs_hook=OrderedDict)
 
@@ -15,11 +15,15 @@
 # for more details.
 #
 
+import ctypes
+import errno
 import gobject
 import os
 import socket
 import subprocess
 import sys
+import threading
+import time
 import traceback
 import webbrowser
 
@@ -35,6 +39,36 @@ else:
     socketpair = socket.socketpair
 # pylint: enable=unused-import,invalid-name
 
+# Kernel-side copying between file descriptors.  Python 2 has neither
+# os.sendfile() nor os.copy_file_range(), so we call libc directly.
+if sys.platform.startswith('linux'):
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _copy_file_range = getattr(_libc, 'copy_file_range', None)
+    if _copy_file_range is not None:
+        _copy_file_range.argtypes = [ctypes.c_int,
+                ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+                ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t,
+                ctypes.c_uint]
+        _copy_file_range.restype = ctypes.c_ssize_t
+    _sendfile = _libc.sendfile64
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+    _pwrite = _libc.pwrite64
+    _pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+            ctypes.c_int64]
+    _pwrite.restype = ctypes.c_ssize_t
+else:
+    _copy_file_range = _sendfile = _pwrite = None
+
+# lseek() whence values for skipping holes, which the Python 2 os module
+# lacks.  Other platforms reject them with EINVAL.
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# Granularity of zero detection when writing sparse files
+SPARSE_BLOCK_SIZE = 4096
+
 
 class DetailException(Exception):
     def __init__(self, msg, detail=None):
@@ -162,6 +196,113 @@ def get_modified_cache_dir():
     return path
 
 
+def copy_fd_range(in_fd, offset, out_fd, count):
+    '''Copy count bytes at offset in in_fd to the current position of
+    out_fd without passing them through userspace.  The position of out_fd
+    is advanced; the position of in_fd is not.  Returns the number of bytes
+    copied, which is less than count only at EOF.  Raises OSError with
+    ENOSYS or EINVAL if the kernel can't copy between these descriptors.'''
+    if _sendfile is None:
+        raise OSError(errno.ENOSYS, 'Kernel-side copying not supported')
+    position = ctypes.c_int64(offset)
+    use_copy_file_range = _copy_file_range is not None
+    copied = 0
+    while copied < count:
+        # Avoid 32-bit size_t limits
+        cur = min(count - copied, 1 << 30)
+        if use_copy_file_range:
+            ret = _copy_file_range(in_fd, ctypes.byref(position), out_fd,
+                    None, cur, 0)
+        else:
+            ret = _sendfile(out_fd, in_fd, ctypes.byref(position), cur)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if use_copy_file_range and err in (errno.ENOSYS, errno.EXDEV,
+                    errno.EINVAL, errno.EOPNOTSUPP):
+                # Old kernel or unsupported filesystem pair
+                use_copy_file_range = False
+                continue
+            raise OSError(err, os.strerror(err))
+        if ret == 0:
+            break
+        copied += ret
+    return copied
+
+
+def have_pwrite():
+    return _pwrite is not None
+
+
+def pwrite(fd, buf, count, offset, start=0):
+    '''Write count bytes of bytearray buf, beginning at start, to fd at
+    offset, without moving the file position.'''
+    if _pwrite is None:
+        raise OSError(errno.ENOSYS, 'pwrite() not supported')
+    if start + count > len(buf):
+        raise ValueError('count exceeds buffer length')
+    base = ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf)) + \
+            start
+    written = 0
+    while written < count:
+        ret = _pwrite(fd, base + written, count - written, offset + written)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        written += ret
+
+
+def data_runs(buf, count, block_size=SPARSE_BLOCK_SIZE):
+    '''Return a list of (start, end) offsets of the runs of blocks within
+    the first count bytes of buf that are not entirely zero.'''
+    view = memoryview(buf)
+    zero = '\0' * block_size
+    runs = []
+    run_start = None
+    for start in xrange(0, count, block_size):
+        end = min(start + block_size, count)
+        # Compared with memcmp()
+        if view[start:end] == zero[:end - start]:
+            if run_start is not None:
+                runs.append((run_start, start))
+                run_start = None
+        elif run_start is None:
+            run_start = start
+    if run_start is not None:
+        runs.append((run_start, count))
+    return runs
+
+
+def data_extents(fd, offset, length):
+    '''Return a list of (start, end) offsets of the extents of fd within
+    the specified range that contain data, omitting holes, or None if the
+    filesystem can't report them.  Moves the file position.'''
+    extents = []
+    end = offset + length
+    pos = offset
+    try:
+        while pos < end:
+            try:
+                start = os.lseek(fd, pos, SEEK_DATA)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # No data after pos
+                    break
+                raise
+            if start >= end:
+                break
+            pos = min(os.lseek(fd, start, SEEK_HOLE), end)
+            extents.append((start, pos))
+    except OSError, e:
+        if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+            return None
+        raise
+    return extents
+
+
 def ensure_dir(path):
     # Not atomic, but avoids hardcoding errno values for Windows
     if not os.path.isdir(path):
@@ -207,9 +348,103 @@ def setup_libvirt():
     libvirt.registerErrorHandler(lambda _ctx, _error: None, None)
 
 
+class HttpConnectionPool(object):
+    '''A thread-safe pool of keep-alive HTTP connections, shared by all
+    requests sessions in the process.  Each host gets a pool of up to
+    pool_size connections; a host's pool is closed after it has been idle
+    for idle_timeout seconds.  Sessions are mounted on the pool as a
+    transport adapter, so they keep their own cookies and headers.'''
+
+    def __init__(self, pool_size=10, idle_timeout=60):
+        from requests.adapters import HTTPAdapter
+        self._adapter = HTTPAdapter(pool_connections=pool_size,
+                pool_maxsize=pool_size)
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # urllib3 connection pool -> [active requests, last use]
+        self._hosts = {}
+        self._requests = 0
+        self._misses = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'hits': self._requests - self._misses,
+                'misses': self._misses,
+                'hosts': len(self._hosts),
+            }
+
+    def _evict_idle(self):
+        # Called with lock held
+        now = time.time()
+        pools = self._adapter.poolmanager.pools
+        for pool, (active, last_used) in self._hosts.items():
+            if active == 0 and now - last_used > self._idle_timeout:
+                del self._hosts[pool]
+                for key in pools.keys():
+                    if pools.get(key) is pool:
+                        # Closes the pool's connections
+                        del pools[key]
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self._evict_idle()
+            pool = self._adapter.get_connection(request.url,
+                    kwargs.get('proxies'))
+            state = self._hosts.setdefault(pool, [0, 0])
+            state[0] += 1
+            connections = pool.num_connections
+        try:
+            return self._adapter.send(request, **kwargs)
+        finally:
+            with self._lock:
+                state[0] -= 1
+                state[1] = time.time()
+                self._requests += 1
+                # Any connection opened for this request (or concurrently
+                # on the same host) is a miss
+                self._misses += pool.num_connections - connections
+
+    def close(self):
+        # Sessions close their adapters when they are closed, but our
+        # connections outlive any one session
+        pass
+
+
+_http_pool = None
+_http_pool_lock = threading.Lock()
+_http_pool_args = {}
+
+
+def configure_http_pool(pool_size=None, idle_timeout=None):
+    '''Set parameters of the process-wide HTTP connection pool.  Must be
+    called before the pool is first used.'''
+    if pool_size is not None:
+        _http_pool_args['pool_size'] = pool_size
+    if idle_timeout is not None:
+        _http_pool_args['idle_timeout'] = idle_timeout
+
+
+def get_http_pool():
+    # We're modifying a module-level singleton
+    # pylint: disable=global-statement
+    global _http_pool
+    # pylint: enable=global-statement
+    with _http_pool_lock:
+        if _http_pool is None:
+            _http_pool = HttpConnectionPool(**_http_pool_args)
+        return _http_pool
+
+
 def get_requests_session():
     import requests
     session = requests.Session()
+    if hasattr(session, 'mount'):
+        pool = get_http_pool()
+        session.mount('http://', pool)
+        session.mount('https://', pool)
     if hasattr(requests.utils, 'default_user_agent'):
         session.headers['User-Agent'] = 'vmnetx/%s %s' % (
                 __version__, requests.utils.default_user_agent())